@@ -123,13 +123,13 @@ class AudioResponder:
 
     def _transcript_history_iterator(
         self,
-    ) -> typing.AsyncIterator[types.GenericMessage]:
+    ) -> typing.Iterator[types.GenericMessage]:
         voice_messages = self._transcript.message_buffer.get()
         voice_messages.sort(key=lambda message: message.start_time, reverse=True)
 
-        # create an async generator which iterates over the lines
+        # create a generator which iterates over the lines
         # in the transcript
-        async def _gen():
+        def _gen():
             for message in voice_messages:
                 author = discord_utils.author_from_user_id(
                     message.user_id,
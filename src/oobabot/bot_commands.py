@@ -2,6 +2,9 @@
 """
 Implementation of the bot's slash commands.
 """
+import asyncio
+import logging
+import time
 import typing
 
 import discord
@@ -16,12 +19,50 @@ from oobabot import prompt_generator
 from oobabot import repetition_tracker
 from oobabot import templates
 
+# channel types that our commands know how to work in
+_MESSAGEABLE_CHANNEL_TYPES = (
+    discord.TextChannel,
+    discord.Thread,
+    discord.DMChannel,
+    discord.GroupChannel,
+)
+
+
+async def _deferred(interaction: discord.Interaction, ephemeral: bool = True):
+    """
+    Acknowledge the interaction straight away, so that any slow work we
+    do afterwards can't push us past Discord's 3-second response window.
+    Responses must then be sent with interaction.followup.
+
+    Do this before anything which might need the REST API, like
+    _get_messageable().  fail_interaction() still replies privately,
+    even when we deferred publicly.
+    """
+    await interaction.response.defer(ephemeral=ephemeral, thinking=False)
+
+
+def _log_command(interaction: discord.Interaction, channel: discord.abc.Messageable):
+    logger = fancy_logger.get()
+    # skip building the channel name when debug logging is off
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    logger.debug(
+        "/%s called by user '%s' in %s",
+        interaction.command.name if interaction.command else "<unknown>",
+        interaction.user.name,
+        discord_utils.get_channel_name(channel),
+    )
+
 
 class BotCommands:
     """
     Implementation of the bot's slash commands.
     """
 
+    # how long, in seconds, to remember a channel we had to fetch over
+    # the REST API because it wasn't in discord.py's cache (e.g. DMs)
+    FETCHED_CHANNEL_TTL = 300.0
+
     def __init__(
         self,
         decide_to_respond: decide_to_respond.DecideToRespond,
@@ -38,9 +79,14 @@ class BotCommands:
         self.include_lobotomize_response = discord_settings["include_lobotomize_response"]
         self.reply_in_thread = discord_settings["reply_in_thread"]
         self.history_lines = discord_settings["history_lines"]
-        self.ignore_prefixes = discord_settings["ignore_prefixes"]
+        # str.startswith() accepts a tuple, and checks every prefix in one call
+        self.ignore_prefixes = tuple(discord_settings["ignore_prefixes"])
         self.template_store = template_store
         self.ooba_client = ooba_client
+        # channel_id -> (time fetched, channel)
+        self._fetched_channels: typing.Dict[
+            int, typing.Tuple[float, discord.abc.Messageable]
+        ] = {}
 
         (
             self.discrivener_location,
@@ -86,265 +132,300 @@ class BotCommands:
                 self.post_voice_replies,
             )
 
-    async def on_ready(self, client: discord.Client):
-        """
-        Register commands with Discord.
-        """
+        # build the command objects once, rather than every time
+        # we (re)connect to Discord
+        self.commands = self._make_commands()
+        self._command_tree: typing.Optional[discord.app_commands.CommandTree] = None
+        self._commands_synced = False
 
-        async def get_messageable(
-            interaction: discord.Interaction,
-        ) -> (
-            typing.Optional[
-                typing.Union[
-                    discord.TextChannel,
-                    discord.Thread,
-                    discord.DMChannel,
-                    discord.GroupChannel,
-                ]
-            ]
-        ):
-            if interaction.channel_id:
-                try:
-                    channel = await interaction.client.fetch_channel(interaction.channel_id)
-                    if channel:
-                        if isinstance(
-                            channel,
-                            (
-                                discord.TextChannel,
-                                discord.Thread,
-                                discord.DMChannel,
-                                discord.GroupChannel
-                            )
-                        ):
-                            return channel
-                except discord.DiscordException as err:
-                    fancy_logger.get().error(
-                        "Error while fetching channel for command: %s", err, exc_info=True
-                    )
-                return
+    def _make_commands(self) -> typing.List[discord.app_commands.Command]:
+        ai_name = self.persona.ai_name
 
+        lobotomize = discord.app_commands.Command(
+            name="lobotomize",
+            description=f"Erase {ai_name}'s memory of any message "
+            + "before now in this channel.",
+            callback=self._lobotomize,
+        )
 
-        @discord.app_commands.command(
-            name="stop",
-            description=f"Force {self.persona.ai_name} to stop typing the current message.",
+        say = discord.app_commands.Command(
+            name="say",
+            description=f"Force {ai_name} to say the provided message.",
+            callback=self._say,
         )
-        async def stop(interaction: discord.Interaction):
-            channel = await get_messageable(interaction)
-            if not channel:
-                await discord_utils.fail_interaction(interaction)
-                return
+        say = discord.app_commands.rename(text_to_send="message")(say)
+        say = discord.app_commands.describe(
+            text_to_send=f"Message to force {ai_name} to say."
+        )(say)
 
-            channel_name = discord_utils.get_channel_name(channel)
-            fancy_logger.get().debug(
-                "/%s called by user '%s' in %s",
-                interaction.command.name,
-                interaction.user.name,
-                channel_name,
-            )
+        edit = discord.app_commands.Command(
+            name="edit",
+            description=f"Edit {ai_name}'s most recent message in the channel "
+            + "with the provided message.",
+            callback=self._edit,
+        )
+        edit = discord.app_commands.rename(text_to_send="message")(edit)
+        edit = discord.app_commands.describe(
+            text_to_send=f"Message to replace {ai_name}'s last message with."
+        )(edit)
 
-            if self.ooba_client.api_type not in ["oobabooga", "openai", "tabbyapi"]:
-                await discord_utils.fail_interaction(
-                    interaction,
-                    "Generic OpenAI-compatible API in use, cannot abort generation.",
-                )
-                return
-            response = await self.ooba_client.stop()
-            str_response = response if response else "No response from server."
-            await interaction.response.send_message(str_response)
+        stop = discord.app_commands.Command(
+            name="stop",
+            description=f"Force {ai_name} to stop typing the current message.",
+            callback=self._stop,
+        )
 
-        @discord.app_commands.command(
+        poke = discord.app_commands.Command(
             name="poke",
-            description=f"Prompt {self.persona.ai_name} to write a response to the last message."
+            description=f"Prompt {ai_name} to write a response to the last message.",
+            callback=self._poke,
         )
-        async def poke(interaction: discord.Interaction):
-            channel = await get_messageable(interaction)
-            if not channel:
-                await discord_utils.fail_interaction(interaction)
-                return
 
-            channel_name = discord_utils.get_channel_name(channel)
-            fancy_logger.get().debug(
-                "/%s called by user '%s' in %s",
-                interaction.command.name,
-                interaction.user.name,
-                channel_name,
-            )
-
-            async for message in channel.history(limit=self.history_lines):
-                for ignore_prefix in self.ignore_prefixes:
-                    if message.content.startswith(ignore_prefix):
-                        continue
-                await interaction.response.defer(ephemeral=True, thinking=False)
-                await interaction.delete_original_response()
-                # respond with certainty
-                self.decide_to_respond.guaranteed_response = True
-                # log a fake mention so the bot considers responses from now on
-                self.decide_to_respond.log_mention(
-                    channel_id=channel.id,
-                    send_timestamp=interaction.created_at.timestamp(),
-                )
-                # trigger a fake message request
-                #return client.dispatch("message", message)
-
-        @discord.app_commands.command(
-            name="say",
-            description=f"Force {self.persona.ai_name} to say the provided message.",
-        )
-        @discord.app_commands.rename(text_to_send="message")
-        @discord.app_commands.describe(
-            text_to_send=f"Message to force {self.persona.ai_name} to say."
-        )
-        async def say(interaction: discord.Interaction, text_to_send: str):
-            channel = await get_messageable(interaction)
-            if not channel:
-                await discord_utils.fail_interaction(interaction)
-                return
+        return [lobotomize, say, edit, stop, poke]
 
-            # if reply_in_thread is True, we don't want our bot to
-            # speak in guild channels, only threads and private messages
-            if self.reply_in_thread:
-                if not channel or isinstance(channel, discord.TextChannel):
-                    await discord_utils.fail_interaction(
-                        interaction,
-                        f"{self.persona.ai_name} may only speak in threads"
+    async def _get_messageable(
+        self,
+        interaction: discord.Interaction,
+    ) -> (
+        typing.Optional[
+            typing.Union[
+                discord.TextChannel,
+                discord.Thread,
+                discord.DMChannel,
+                discord.GroupChannel,
+            ]
+        ]
+    ):
+        channel_id = interaction.channel_id
+        if not channel_id:
+            return None
+
+        # discord.py already caches guild channels, and usually populates
+        # interaction.channel too, so only go to the REST API when both miss.
+        # In DMs interaction.channel may only be a PartialMessageable.
+        channel = interaction.channel
+        if not isinstance(channel, _MESSAGEABLE_CHANNEL_TYPES):
+            channel = interaction.client.get_channel(channel_id)
+        if not isinstance(channel, _MESSAGEABLE_CHANNEL_TYPES):
+            now = time.monotonic()
+            cached = self._fetched_channels.get(channel_id)
+            if cached and now - cached[0] < self.FETCHED_CHANNEL_TTL:
+                channel = cached[1]
+            else:
+                try:
+                    channel = await interaction.client.fetch_channel(channel_id)
+                except discord.DiscordException as err:
+                    fancy_logger.get().error(
+                        "Error while fetching channel for command: %s",
+                        err,
+                        exc_info=True,
                     )
-                    return
-
-            channel_name = discord_utils.get_channel_name(channel)
-            fancy_logger.get().debug(
-                "/%s called by user '%s' in channel #%s",
-                interaction.command.name,
-                interaction.user.name,
-                channel_name,
+                    return None
+                # drop any expired entries, so channels we won't see again
+                # (e.g. archived threads) don't pile up
+                self._fetched_channels = {
+                    cached_id: cached
+                    for cached_id, cached in self._fetched_channels.items()
+                    if now - cached[0] < self.FETCHED_CHANNEL_TTL
+                }
+                self._fetched_channels[channel_id] = (now, channel)
+
+        if isinstance(channel, _MESSAGEABLE_CHANNEL_TYPES):
+            return channel
+        return None
+
+    async def _stop(self, interaction: discord.Interaction):
+        await _deferred(interaction, ephemeral=False)
+        channel = await self._get_messageable(interaction)
+        if not channel:
+            await discord_utils.fail_interaction(interaction)
+            return
+
+        _log_command(interaction, channel)
+
+        if self.ooba_client.api_type not in ["oobabooga", "openai", "tabbyapi"]:
+            await discord_utils.fail_interaction(
+                interaction,
+                "Generic OpenAI-compatible API in use, cannot abort generation.",
             )
-            # this will cause the bot to monitor the channel
-            # and consider unsolicited responses
+            return
+        response = await self.ooba_client.stop()
+        str_response = response if response else "No response from server."
+        await interaction.followup.send(str_response)
+
+    async def _poke(self, interaction: discord.Interaction):
+        await _deferred(interaction)
+        channel = await self._get_messageable(interaction)
+        if not channel:
+            await discord_utils.fail_interaction(interaction)
+            return
+
+        _log_command(interaction, channel)
+
+        ignore_prefixes = self.ignore_prefixes
+        async for message in discord_utils.recent_channel_messages(
+            interaction.client, channel, self.history_lines
+        ):
+            if message.content.startswith(ignore_prefixes):
+                continue
+            await interaction.delete_original_response()
+            # respond with certainty
+            self.decide_to_respond.guaranteed_response = True
+            # log a fake mention so the bot considers responses from now on
             self.decide_to_respond.log_mention(
-                channel_id=interaction.channel_id,
+                channel_id=channel.id,
                 send_timestamp=interaction.created_at.timestamp(),
             )
-            await interaction.response.send_message(
-                text_to_send,
-                suppress_embeds=True,
+            # trigger a fake message request
+            #return client.dispatch("message", message)
+            break
+        else:
+            # nothing to respond to, so don't leave the deferred response hanging
+            await discord_utils.fail_interaction(
+                interaction,
+                f"No recent message for {self.persona.ai_name} to respond to",
             )
 
-        @discord.app_commands.command(
-            name="edit",
-            description=f"Edit {self.persona.ai_name}'s most recent message in the channel "
-            + "with the provided message.",
+    async def _say(self, interaction: discord.Interaction, text_to_send: str):
+        await _deferred(interaction, ephemeral=False)
+        channel = await self._get_messageable(interaction)
+        if not channel:
+            await discord_utils.fail_interaction(interaction)
+            return
+
+        # if reply_in_thread is True, we don't want our bot to
+        # speak in guild channels, only threads and private messages
+        if self.reply_in_thread:
+            if not channel or isinstance(channel, discord.TextChannel):
+                await discord_utils.fail_interaction(
+                    interaction,
+                    f"{self.persona.ai_name} may only speak in threads"
+                )
+                return
+
+        _log_command(interaction, channel)
+        # this will cause the bot to monitor the channel
+        # and consider unsolicited responses
+        self.decide_to_respond.log_mention(
+            channel_id=interaction.channel_id,
+            send_timestamp=interaction.created_at.timestamp(),
         )
-        @discord.app_commands.rename(text_to_send="message")
-        @discord.app_commands.describe(
-            text_to_send=f"Message to replace {self.persona.ai_name}'s last message with."
+        await interaction.followup.send(
+            text_to_send,
+            suppress_embeds=True,
         )
-        async def edit(interaction: discord.Interaction, text_to_send: str):
-            channel = await get_messageable(interaction)
-            if not channel:
-                await discord_utils.fail_interaction(interaction)
-                return
 
-            channel_name = discord_utils.get_channel_name(channel)
-            fancy_logger.get().debug(
-                "/%s called by user '%s' in channel #%s",
-                interaction.command.name,
-                interaction.user.name,
-                channel_name,
-            )
-            self.decide_to_respond.log_mention(
-                channel_id=interaction.channel_id,
-                send_timestamp=interaction.created_at.timestamp(),
-            )
+    async def _edit(self, interaction: discord.Interaction, text_to_send: str):
+        await _deferred(interaction)
+        channel = await self._get_messageable(interaction)
+        if not channel:
+            await discord_utils.fail_interaction(interaction)
+            return
+
+        _log_command(interaction, channel)
+        self.decide_to_respond.log_mention(
+            channel_id=interaction.channel_id,
+            send_timestamp=interaction.created_at.timestamp(),
+        )
 
-            bot_last_message = None
-            skip = False
+        bot_last_message = None
+        bot_user_id = interaction.client.user.id
+        ignore_prefixes = self.ignore_prefixes
 
-            async for message in channel.history(limit=self.history_lines):
-                for ignore_prefix in self.ignore_prefixes:
-                    if message.content.startswith(ignore_prefix):
-                        skip = True
-                        break
-                    skip = False
-                if skip:
-                    continue
+        async for message in discord_utils.recent_channel_messages(
+            interaction.client, channel, self.history_lines
+        ):
+            if message.content.startswith(ignore_prefixes):
+                continue
 
-                if message.author.id == client.user.id:
-                    bot_last_message = message
-                    break
+            if message.author.id == bot_user_id:
+                bot_last_message = message
+                break
 
-            if bot_last_message:
-                await interaction.response.defer(ephemeral=True, thinking=False)
-                await bot_last_message.edit(content=text_to_send)
-                await interaction.delete_original_response()
+        if not bot_last_message:
+            await discord_utils.fail_interaction(
+                interaction,
+                f"No recent message from {self.persona.ai_name} to edit",
+            )
+            return
 
-        @discord.app_commands.command(
-            name="lobotomize",
-            description=f"Erase {self.persona.ai_name}'s memory of any message "
-            + "before now in this channel.",
+        # these are independent REST calls, so don't wait on one
+        # before starting the other
+        await asyncio.gather(
+            bot_last_message.edit(content=text_to_send),
+            interaction.delete_original_response(),
         )
-        async def lobotomize(interaction: discord.Interaction):
-            channel = await get_messageable(interaction)
-            if not channel:
-                await discord_utils.fail_interaction(interaction)
-                return
 
-            channel_name = discord_utils.get_channel_name(channel)
-            fancy_logger.get().debug(
-                "/%s called by user '%s' in channel #%s",
-                interaction.command.name,
-                interaction.user.name,
-                channel_name,
-            )
-
-            response = self.template_store.format(
-                template_name=templates.Templates.COMMAND_LOBOTOMIZE_RESPONSE,
-                format_args={
-                    templates.TemplateToken.AI_NAME: self.persona.ai_name,
-                    templates.TemplateToken.NAME: interaction.user.name,
-                },
+    async def _lobotomize(self, interaction: discord.Interaction):
+        await _deferred(interaction, ephemeral=False)
+        channel = await self._get_messageable(interaction)
+        if not channel:
+            await discord_utils.fail_interaction(interaction)
+            return
+
+        _log_command(interaction, channel)
+
+        response = self.template_store.format(
+            template_name=templates.Templates.COMMAND_LOBOTOMIZE_RESPONSE,
+            format_args={
+                templates.TemplateToken.AI_NAME: self.persona.ai_name,
+                templates.TemplateToken.NAME: interaction.user.name,
+            },
+        )
+        # find the current message in this channel or the
+        # message before that if we're including our response.
+        # tell the Repetition Tracker to hide messages
+        # before this message
+        sent_message = await interaction.followup.send(
+            response,
+            silent=True,
+            suppress_embeds=True,
+            wait=True,
+        )
+        channel_id = channel.id
+        if not self.include_lobotomize_response:
+            fancy_logger.get().debug("Excluding bot response from chat history.")
+            self.repetition_tracker.hide_messages_before(
+                channel_id=channel_id,
+                message_id=sent_message.id,
             )
-            await interaction.response.send_message(
-                response,
-                silent=True,
-                suppress_embeds=True,
+            return
+        # hide everything up to and including the message right before
+        # our response.  Our response may not have reached the message
+        # cache yet, so we ask for what came before it directly.
+        async for message in discord_utils.recent_channel_messages(
+            interaction.client, channel, limit=1, before=sent_message
+        ):
+            self.repetition_tracker.hide_messages_before(
+                channel_id=channel_id,
+                message_id=message.id,
             )
-            # find the current message in this channel or the
-            # message before that if we're including our response.
-            # tell the Repetition Tracker to hide messages
-            # before this message
-            sent_message = await interaction.original_response()
-            if not self.include_lobotomize_response:
-                fancy_logger.get().debug("Excluding bot response from chat history.")
-                self.repetition_tracker.hide_messages_before(
-                    channel_id=channel.id,
-                    message_id=sent_message.id,
-                )
-                return
-            finished = False
-            async for message in channel.history(limit=self.history_lines):
-                if finished:
-                    self.repetition_tracker.hide_messages_before(
-                        channel_id=channel.id,
-                        message_id=message.id,
-                    )
-                    break
-                if message.id == sent_message.id:
-                    finished = True
 
-        fancy_logger.get().debug(
-            "Registering commands, sometimes this takes a while..."
-        )
+    async def on_ready(self, client: discord.Client):
+        """
+        Register commands with Discord.
 
-        tree = discord.app_commands.CommandTree(client)
-        tree.add_command(lobotomize)
-        tree.add_command(say)
-        tree.add_command(edit)
-        tree.add_command(stop)
-        tree.add_command(poke)
+        on_ready fires again on every reconnect, but the commands
+        only need to be synced once per run.
+        """
+        if self._commands_synced:
+            return
+
+        # a client can only ever have one command tree, so hang
+        # on to it in case syncing fails and we try again later
+        if not self._command_tree:
+            self._command_tree = discord.app_commands.CommandTree(client)
+            for command in self.commands:
+                self._command_tree.add_command(command)
 
-        if self.audio_commands:
-            self.audio_commands.add_commands(tree)
+            if self.audio_commands:
+                self.audio_commands.add_commands(self._command_tree)
 
-        commands = await tree.sync(guild=None)
+        fancy_logger.get().debug(
+            "Registering commands, sometimes this takes a while..."
+        )
+        commands = await self._command_tree.sync(guild=None)
+        self._commands_synced = True
         for command in commands:
             fancy_logger.get().info(
                 "Registered command: %s: %s", command.name, command.description
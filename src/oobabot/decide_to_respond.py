@@ -3,6 +3,7 @@
 Decides whether the bot responds to a message.
 """
 
+import heapq
 import random
 import typing
 
@@ -32,17 +33,20 @@ class LastReplyTimes(dict):
         if self.unsolicited_channel_cap > 0:
             # find the n-th largest timestamp
             if self.unsolicited_channel_cap < len(self):
-                nth_largest_timestamp = sorted(self.values())[
-                    -self.unsolicited_channel_cap
-                ]
+                nth_largest_timestamp = heapq.nlargest(
+                    self.unsolicited_channel_cap, self.values()
+                )[-1]
                 oldest_time_to_keep = max(oldest_time_to_keep, nth_largest_timestamp)
-        purged = {
-            channel_id: response_time
+
+        # this runs on every message we consider, and usually there is
+        # nothing to purge, so delete in place rather than rebuilding
+        outdated = [
+            channel_id
             for channel_id, response_time in self.items()
-            if response_time >= oldest_time_to_keep
-        }
-        self.clear()
-        self.update(purged)
+            if response_time < oldest_time_to_keep
+        ]
+        for channel_id in outdated:
+            del self[channel_id]
 
     def log_mention(self, channel_id: int, send_timestamp: float) -> None:
         self[channel_id] = send_timestamp
@@ -171,7 +175,6 @@ class DecideToRespond:
         # clamp the upper-limit of the final chance at 100%
         response_chance = min(1.0, response_chance)
 
-        time_since_last_mention = self.last_reply_times.time_since_last_mention(message)
         fancy_logger.get().debug(
             "Considering unsolicited response in %s after %2.0f seconds.  "
             + "chance: %2.0f%%.",
@@ -5,12 +5,11 @@ be easily extracted into a cross-platform library.
 """
 
 import asyncio
-import io
+from concurrent import futures
+import functools
+import logging
 import re
-import time
 import typing
-from collections import deque
-from PIL import Image
 
 import emoji
 import discord
@@ -31,6 +30,60 @@ from oobabot import types
 from oobabot import vision
 
 
+async def _queue_response_parts(
+    response_iterator: typing.AsyncIterator[str],
+    queue: asyncio.Queue,
+) -> None:
+    """
+    Copies each part of a streamed response into the queue, followed by None
+    when the response is complete, or by the exception if it failed.
+    """
+    try:
+        async for part in response_iterator:
+            await queue.put(part)
+    except Exception as err:
+        await queue.put(err)
+        return
+    finally:
+        # if we were cancelled, close the response right away rather than
+        # leaving its connection open until the generator is collected
+        await _close_response(response_iterator)
+    await queue.put(None)
+
+
+async def _close_response(response_iterator: typing.AsyncIterator[str]) -> None:
+    """
+    Closes a streamed response, if it's a generator which can be closed.
+    This stops the underlying request, so the AI stops generating tokens
+    we aren't going to use.
+    """
+    aclose = getattr(response_iterator, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+# The same few members tend to talk in a channel, so remember the stopping
+# strings we've built for them rather than re-running the template and
+# emoji-stripping work on every response.  These are module functions, so
+# that the caches don't hold on to every bot they've been used by.
+@functools.lru_cache(maxsize=1024)
+def _user_prompt_prefix(template_store: templates.TemplateStore, user_name: str) -> str:
+    return template_store.format(
+        templates.Templates.USER_PROMPT_HISTORY_BLOCK,
+        {
+            templates.TemplateToken.USER_NAME: user_name,
+            templates.TemplateToken.MESSAGE: "",
+        },
+    ).strip()
+
+
+@functools.lru_cache(maxsize=1024)
+def _canonicalized_name(user_name: str) -> str:
+    name = emoji.replace_emoji(user_name, "")
+    canonicalized_name = name.split()[0].strip().capitalize()
+    return canonicalized_name if len(canonicalized_name) >= 3 else name
+
+
 class DiscordBot(discord.Client):
     """
     Main bot class.  Connects to Discord, monitors for messages,
@@ -67,7 +120,11 @@ class DiscordBot(discord.Client):
 
         self.dont_split_responses = discord_settings["dont_split_responses"]
         self.ignore_dms = discord_settings["ignore_dms"]
-        self.ignore_prefixes = discord_settings["ignore_prefixes"]
+        # str.startswith() accepts a tuple, and checks every prefix in one call.
+        # Shortest first, as shorter prefixes are the likeliest to match.
+        self.ignore_prefixes = tuple(
+            sorted(dict.fromkeys(discord_settings["ignore_prefixes"]), key=len)
+        )
         self.message_accumulation_period = round(
             discord_settings["message_accumulation_period"], 1
         )
@@ -97,6 +154,16 @@ class DiscordBot(discord.Client):
                 f"Unknown value '{self.prevent_impersonation}' for `prevent_impersonation`. "
                 + "Please fix your configuration."
             )
+        # which stopping strings prevent_impersonation adds for each member, decided
+        # once here rather than by comparing the mode's name on every response
+        self._impersonation_adds_prompt_prefix = self.prevent_impersonation in (
+            "standard",
+            "comprehensive",
+        )
+        self._impersonation_adds_name = self.prevent_impersonation in (
+            "aggressive",
+            "comprehensive",
+        )
         self.stream_responses = discord_settings["stream_responses"]
         if self.stream_responses and self.stream_responses not in ["token", "sentence"]:
             raise ValueError(
@@ -104,23 +171,151 @@ class DiscordBot(discord.Client):
                 + "Please fix your configuration."
             )
         self.stream_responses_speed_limit = discord_settings["stream_responses_speed_limit"]
-
-        # add stopping_strings to stop_markers
-        self.stop_markers.extend(self.ooba_client.get_stopping_strings())
+        # the member names and stopping strings from the most recent response,
+        # see _get_impersonation_stopping_strings()
+        self._last_impersonation_stopping_strings: typing.Tuple[
+            typing.Tuple[str, ...], typing.List[str]
+        ] = ((), [])
+
+        # add stopping_strings to stop_markers, dropping duplicates.  Longest
+        # first, so that when one marker contains another we cut at the more
+        # specific one.
+        self.stop_markers = tuple(
+            sorted(
+                dict.fromkeys(
+                    [*self.stop_markers, *self.ooba_client.get_stopping_strings()]
+                ),
+                key=len,
+                reverse=True,
+            )
+        )
+        # and compile them into one pattern, so that a sentence is scanned once
+        # for all of them.  At any position, the longest marker wins.
+        self._stop_marker_regex: typing.Optional[typing.Pattern[str]] = None
+        if any(self.stop_markers):
+            self._stop_marker_regex = re.compile(
+                "|".join(re.escape(marker) for marker in self.stop_markers if marker)
+            )
 
         # Identify our intents with the Gateway
         super().__init__(intents=discord_utils.get_intents())
 
-        # Instantiate double-ended message queue
-        self.message_queue = deque()
+        # Messages waiting to be processed, in the order they were received.
+        # Created in setup_hook, once the event loop is running, and drained
+        # by a single long-lived worker task.
+        self.message_queue: typing.Optional[asyncio.Queue] = None
+        # IDs of the messages currently in message_queue, so that we can
+        # drop queued messages which are deleted before we get to them
+        self.queued_message_ids: typing.Set[int] = set()
+        # set whenever a message is queued, to wake anything waiting for more
+        self._message_queued: typing.Optional[asyncio.Event] = None
+        self._queue_worker_task: typing.Optional[asyncio.Task] = None
+        # looks for image URLs in message text, if we fetch them
+        self._find_image_urls: typing.Optional[
+            typing.Callable[[str], typing.List[str]]
+        ] = None
+        if vision_client and vision_client.fetch_urls:
+            self._find_image_urls = vision_client.url_extractor.findall
+        # Decoding and resizing images is CPU-bound.  Threads are enough for
+        # the odd attachment, but PIL holds the GIL for parts of the work, so
+        # optionally hand it to separate processes instead.
+        self._image_pool: typing.Optional[futures.ProcessPoolExecutor] = None
+        if vision_client and vision_client.image_processing_workers > 0:
+            self._image_pool = futures.ProcessPoolExecutor(
+                max_workers=vision_client.image_processing_workers
+            )
+        # The immersion breaking filter looks for lines where the AI is speaking
+        # as someone else, using these.  Neither the templates nor the AI's name
+        # change while we're running, so build them once.
+        name_identifier = "%%%%%%%%NAME%%%%%%%%"
+        username_pattern = self.template_store.format(
+            templates.Templates.USER_PROMPT_HISTORY_BLOCK,
+            {
+                templates.TemplateToken.USER_NAME: self.template_store.format(
+                    templates.Templates.USER_NAME,
+                    {
+                        templates.TemplateToken.NAME: name_identifier,
+                    },
+                ),
+                templates.TemplateToken.MESSAGE: "",
+            },
+        ).strip("\n")
+        # Discord usernames are 2-32 characters long, and can only contain special
+        # characters '_' and '.' but display names are 1-32 characters long and can
+        # contain almost anything, so we try to account for the more permissive option.
+        # Hopefully results in fewer false positives than matching anything. Using a
+        # prompt history block like "[{USER_NAME}]: {MESSAGE}" will work better.
+        username_pattern = re.escape(username_pattern).replace(
+            name_identifier, r"[\S ]{1,32}"
+        )
+        self._username_message_pattern = re.compile(
+            r"^(" + username_pattern + r")(.*)$"
+        )
+        self._ai_name_prompt = self.template_store.format(
+            templates.Templates.BOT_PROMPT_HISTORY_BLOCK,
+            {
+                templates.TemplateToken.BOT_NAME: self.template_store.format(
+                    templates.Templates.BOT_NAME,
+                    {
+                        templates.TemplateToken.NAME: self.persona.ai_name,
+                    },
+                ),
+                templates.TemplateToken.MESSAGE: "",
+            },
+        ).strip("\n")
+
         # Get a sentence segmenter ready
         self.sentence_splitter = pysbd.Segmenter(language="en", clean=False)
         # and set a regex pattern that we will use to split lines apart. Avoids code
         # duplication in each method where we do this. This must not be a raw string,
         # otherwise the str.strip() method can't use it properly.
         self.line_split_pattern = "\r\n\t\f\v"
+        self._line_split_regex = re.compile(r"([" + self.line_split_pattern + r"]+)")
+        # Text without any of these can't be split into more than one line or
+        # sentence, so the immersion filter can skip splitting it.  As well as
+        # sentence terminators, pysbd also splits at closing quotes and at
+        # list markers like "1)".
+        self._sentence_break_regex = re.compile(
+            "[" + re.escape(self.line_split_pattern + ".!?。！？)\"'“”‘’«»") + "]"
+        )
+
+        # per guild ID or group DM channel ID, see _get_user_id_to_name_resolver()
+        self._user_id_to_name_resolvers: typing.Dict[
+            int, typing.Callable[[typing.Match[str]], str]
+        ] = {}
+
+    async def setup_hook(self) -> None:
+        self.message_queue = asyncio.Queue()
+        self._message_queued = asyncio.Event()
+        self._queue_worker_task = asyncio.create_task(self._queue_worker())
+
+    # how long to give a response in progress to clean up when closing
+    CLOSE_TIMEOUT_SECONDS = 5.0
+
+    async def close(self) -> None:
+        if self._queue_worker_task:
+            queue_worker_task = self._queue_worker_task
+            self._queue_worker_task = None
+            # cancelling the worker cancels any response it's working on, so
+            # wait for that to stop its AI request before we disconnect
+            queue_worker_task.cancel()
+            try:
+                await asyncio.wait_for(
+                    queue_worker_task, timeout=self.CLOSE_TIMEOUT_SECONDS
+                )
+            except asyncio.TimeoutError:
+                fancy_logger.get().warning("Message queue worker did not stop in time")
+            except asyncio.CancelledError:
+                pass
+        await super().close()
+        if self._image_pool:
+            self._image_pool.shutdown(wait=False)
+            self._image_pool = None
 
     async def on_ready(self) -> None:
+        # a new session brings new guild objects, so don't keep resolving
+        # names with the old ones
+        self._user_id_to_name_resolvers.clear()
         guilds = self.guilds
         num_guilds = len(guilds)
         num_channels = sum(len(guild.channels) for guild in guilds)
@@ -160,11 +355,13 @@ class DiscordBot(discord.Client):
             "History: %d lines ", self.prompt_generator.history_lines
         )
 
-        if self.stop_markers:
+        # on_ready runs again on every reconnect, and the stop markers can include
+        # every stopping string, so only format them if they'll be logged
+        if self.stop_markers and fancy_logger.get().isEnabledFor(logging.DEBUG):
             fancy_logger.get().debug(
                 "Stop markers: %s",
                 ", ".join(
-                    [f"'{stop_marker}'" for stop_marker in self.stop_markers]
+                    f"'{stop_marker}'" for stop_marker in self.stop_markers
                 ).replace("\n", "\\n")
             )
 
@@ -219,50 +416,64 @@ class DiscordBot(discord.Client):
         :param raw_message: The raw message from Discord.
         """
 
-        try:
-            # Don't respond to the thread creation system message
-            if raw_message.type == discord.MessageType.thread_created:
-                return
-            # Add the message to the queue
-            self.message_queue.appendleft(raw_message)
-            # Start processing the message queue for the first message received
-            if len(self.message_queue) == 1:
-                self.loop.create_task(
-                    self.process_message_queue(raw_message.channel, self.message_queue)
-                )
-
-        except discord.DiscordException as err:
-            fancy_logger.get().error(
-                "Error while queueing message for processing: %s", err, exc_info=True
-            )
+        # Don't respond to the thread creation system message
+        if raw_message.type == discord.MessageType.thread_created:
+            return
+        if self.message_queue is None:
+            return
+        # Hand the message over to the queue worker
+        self.queued_message_ids.add(raw_message.id)
+        self.message_queue.put_nowait(raw_message)
+        self._message_queued.set()
 
-    async def on_message_delete(self, raw_message: discord.Message) -> None:
+    async def on_raw_message_delete(
+        self, payload: discord.RawMessageDeleteEvent
+    ) -> None:
         """
         Called when a message is deleted from Discord.
 
-        This method is called for every message in the cache that is deleted,
-        checks if that message is in our message queue, and removes it if so.
+        Unlike on_message_delete, this is called even if the message
+        isn't in discord.py's message cache.  Checks if that message is
+        in our message queue, and drops it if so.
         """
-        if raw_message in self.message_queue:
-            self.message_queue.remove(raw_message)
+        self.queued_message_ids.discard(payload.message_id)
+
+    # hide history, delete message, regenerate message
+    REACTION_EMOJI = ("⏪", "❌", "🔁")
 
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent) -> None:
-        channel = await self.fetch_channel(payload.channel_id)
-        reactor = await self.fetch_user(payload.user_id)
-        try:
-            raw_message = await channel.fetch_message(payload.message_id)
-        # Sometimes the message is already deleted before we can process it, e.g.
-        # the PluralKit bot uses ❌ to delete messages too, so we account for that.
-        except discord.NotFound:
+        # Most reactions are nothing to do with us, so rule out as many as we can
+        # from the payload alone, before making any API calls.
+        if (
+            payload.emoji.name not in self.REACTION_EMOJI
+            or payload.user_id == self.bot_user_id
+        ):
             return
+        # message_author_id is only sent for reactions in guilds, and only
+        # exists in discord.py 2.4 and up
+        message_author_id = getattr(payload, "message_author_id", None)
+        if (
+            payload.emoji.name != "⏪"
+            and message_author_id is not None
+            and message_author_id != self.bot_user_id
+        ):
+            return
+
+        channel = self.get_channel(payload.channel_id)
+        if channel is None:
+            channel = await self.fetch_channel(payload.channel_id)
+        # member is only sent for reactions in guilds
+        reactor = payload.member or self.get_user(payload.user_id)
 
         # hide all chat history at and before this message
         if payload.emoji.name == "⏪":
-            fancy_logger.get().debug(
-                "Received request from %s to hide chat history in %s.",
-                reactor.name,
-                discord_utils.get_channel_name(channel),
-            )
+            # skip building the channel name when debug logging is off
+            if fancy_logger.get().isEnabledFor(logging.DEBUG):
+                fancy_logger.get().debug(
+                    "Received request from %s to hide chat history in %s.",
+                    reactor.name if reactor else payload.user_id,
+                    discord_utils.get_channel_name(channel),
+                )
 
             # Hide the chat from the message before our reacted message
             #finished = False
@@ -279,28 +490,42 @@ class DiscordBot(discord.Client):
             # Include the reacted message in the hidden chat history
             self.repetition_tracker.hide_messages_before(
                 channel_id=channel.id,
-                message_id=raw_message.id,
+                message_id=payload.message_id,
             )
-            try:
-                await raw_message.clear_reaction(payload.emoji)
-            except (discord.Forbidden, discord.NotFound):
-                # We can't remove reactions on other users' messages in DMs or Group DMs.
-                # Also give up if the reaction isn't there anymore (i.e. someone removed
-                # it before we could), or we simply have no permission.
-                pass
+            # We can't remove reactions on other users' messages in Group DMs.
+            # Otherwise, we only need the message's ID, so don't fetch it.
+            if not isinstance(channel, discord.GroupChannel):
+                await self._clear_reaction(
+                    channel.get_partial_message(payload.message_id), payload.emoji
+                )
             return
 
-        # only process the below reactions if it was to one of our messages
-        if raw_message.author.id != self.bot_user_id:
-            return
+        if payload.emoji.name == "❌" and message_author_id == self.bot_user_id:
+            # we already know it's one of our messages, and deleting it only
+            # needs its ID, so don't fetch it
+            raw_message = channel.get_partial_message(payload.message_id)
+        else:
+            try:
+                raw_message = await channel.fetch_message(payload.message_id)
+            # Sometimes the message is already deleted before we can process it,
+            # e.g. the PluralKit bot uses ❌ to delete messages too, so we account
+            # for that.
+            except discord.NotFound:
+                return
+
+            # only process the below reactions if it was to one of our messages
+            if raw_message.author.id != self.bot_user_id:
+                return
 
         # message deletion
         if payload.emoji.name == "❌":
-            fancy_logger.get().debug(
-                "Received message deletion request from %s in %s. Deleting message...",
-                raw_message.author.name,
-                discord_utils.get_channel_name(channel),
-            )
+            if fancy_logger.get().isEnabledFor(logging.DEBUG):
+                fancy_logger.get().debug(
+                    "Received message deletion request from %s in %s. "
+                    + "Deleting message...",
+                    reactor.name if reactor else payload.user_id,
+                    discord_utils.get_channel_name(channel),
+                )
             try:
                 await raw_message.delete()
             except discord.NotFound:
@@ -313,38 +538,58 @@ class DiscordBot(discord.Client):
             message = discord_utils.discord_message_to_generic_message(raw_message)
             fancy_logger.get().debug(
                 "Received message regeneration request from %s. Regenerating message...",
-                raw_message.author.name,
+                reactor.name if reactor else payload.user_id,
             )
             try:
                 async with channel.typing():
                     await self._regenerate_message(message, raw_message, channel)
                 if isinstance(channel, (discord.DMChannel, discord.GroupChannel)):
                     return
-                try:
-                    await raw_message.clear_reaction(payload.emoji)
-                except (discord.Forbidden, discord.NotFound):
-                    pass
+                await self._clear_reaction(raw_message, payload.emoji)
             except discord.DiscordException as err:
                 fancy_logger.get().error(
                     "Error while processing reaction: %s", err, exc_info=True
                 )
                 self.response_stats.log_response_failure()
 
-    async def process_message_queue(
-            self,
-            channel: typing.Union[
-                discord.abc.GuildChannel,
-                discord.Thread,
-                discord.DMChannel,
-                discord.GroupChannel,
-            ],
-            message_queue: typing.Deque[discord.Message]
-        ) -> None:
+    async def _clear_reaction(
+        self,
+        message: typing.Union[discord.Message, discord.PartialMessage],
+        reaction: discord.PartialEmoji,
+    ) -> None:
+        """
+        Removes a reaction we've acted on, if we're able to.
+        """
+        try:
+            await message.clear_reaction(reaction)
+        except (discord.Forbidden, discord.NotFound):
+            # We can't remove reactions on other users' messages in DMs.
+            # Also give up if the reaction isn't there anymore (i.e. someone removed
+            # it before we could), or we simply have no permission.
+            pass
+
+    async def _queue_worker(self) -> None:
         """
-        Loops through the message queue and responds to each message in received
-        order, also handling any additional messages that are queued while
-        processing is in progress.
+        Waits for messages to arrive in the message queue, and responds
+        to each of them in received order.
         """
+        while True:
+            raw_message = await self.message_queue.get()
+            try:
+                await self.process_message_queue(raw_message)
+            except Exception as err:
+                # keep the worker alive, whatever happens to one batch
+                fancy_logger.get().error(
+                    "Error while processing message queue: %s", err, exc_info=True
+                )
+
+    async def process_message_queue(self, first_message: discord.Message) -> None:
+        """
+        Responds to the given message, and then to any additional messages
+        that are queued while processing is in progress, in received order.
+        """
+        channel = first_message.channel
+        queued_message_ids = self.queued_message_ids
         # Wait if we're accumulating messages. We avoid this in DMs or Group DMs
         # rather arbitrarily, as the feature was initially designed for bots like
         # PluralKit and Tupperbox that rapidly delete and re-post user messages
@@ -355,71 +600,81 @@ class DiscordBot(discord.Client):
             and not isinstance(channel, (discord.DMChannel, discord.GroupChannel))
         ):
             if self.continue_on_additional_messages:
-                start_time = time.time()
-                while (
-                    len(message_queue) < self.continue_on_additional_messages + 1
-                    and time.time() < start_time + self.message_accumulation_period
-                ):
-                    await asyncio.sleep(0.1)
+                # wake up as each message arrives, rather than polling
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + self.message_accumulation_period
+                message_queued = self._message_queued
+                enough_messages = self.continue_on_additional_messages + 1
+                while len(queued_message_ids) < enough_messages:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    message_queued.clear()
+                    try:
+                        await asyncio.wait_for(message_queued.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
             else:
                 await asyncio.sleep(self.message_accumulation_period)
 
-        # If the queue is empty, abort response
-        if not message_queue:
-            return
-        # otherwise, process the message queue in order of messages received
-        while message_queue:
-            raw_message = message_queue.pop()
-
-            message = discord_utils.discord_message_to_generic_message(raw_message)
-            should_respond, is_summon = self.decide_to_respond.should_reply_to_message(
-                self.bot_user_id, message
-            )
-            # Did we guarantee a response? If so, take note of the state and immediately
-            # reset the flag. This is crucial to remember to do otherwise we will get into
-            # an infinite recursive loop of responding to ourselves.
-            guaranteed_response = self.decide_to_respond.guaranteed_response
-            if guaranteed_response:
-                self.decide_to_respond.guaranteed_response = False
-            if not should_respond:
-                continue
-            is_summon_in_public_channel = is_summon and isinstance(
-                message, types.ChannelMessage
-            )
-
-            # Sometimes it's the case where the message we got has already been deleted.
-            # We attempt to prevent this as much as possible, but it might still happen.
+        # process the message queue in order of messages received, skipping
+        # any that were deleted while they were waiting
+        get_next_message = self.message_queue.get_nowait
+        raw_message = first_message
+        while True:
             try:
-                await channel.fetch_message(message.message_id)
-            except discord.NotFound:
-                continue
+                queued_message_ids.remove(raw_message.id)
+            except KeyError:
+                pass  # deleted while it was waiting
+            else:
+                await self._process_message(raw_message)
+            try:
+                raw_message = get_next_message()
+            except asyncio.QueueEmpty:
+                break
 
-            # If the message is hidden, ignore it and move on. We do this here instead of in
-            # decide_to_respond, in case the user is using something like PluralKit or
-            # Tupperbox and the original message (which was deleted) began with a different
-            # sequence. Because we wait to accumulate messages, this ensures the deleted
-            # message doesn't trigger a response to whatever the latest message ends up being.
-            if not guaranteed_response:
-                skip = False
-                for ignore_prefix in self.ignore_prefixes:
-                    if message.body_text.startswith(ignore_prefix):
-                        skip = True
-                        break
-                    skip = False
-                if skip:
-                    continue
+    async def _process_message(self, raw_message: discord.Message) -> None:
+        """
+        Decides whether to respond to a single queued message, and
+        responds to it if so.
+        """
+        channel = raw_message.channel
+        decide_to_respond = self.decide_to_respond
+        message = discord_utils.discord_message_to_generic_message(raw_message)
+        should_respond, is_summon = decide_to_respond.should_reply_to_message(
+            self.bot_user_id, message
+        )
+        # Did we guarantee a response? If so, take note of the state and immediately
+        # reset the flag. This is crucial to remember to do otherwise we will get into
+        # an infinite recursive loop of responding to ourselves.
+        guaranteed_response = decide_to_respond.guaranteed_response
+        if guaranteed_response:
+            decide_to_respond.guaranteed_response = False
+        if not should_respond:
+            return
+        is_summon_in_public_channel = is_summon and isinstance(
+            message, types.ChannelMessage
+        )
 
-            try:
-                async with channel.typing():
-                    await self._handle_response(
-                        message,
-                        raw_message,
-                        is_summon_in_public_channel,
-                    )
-            except discord.DiscordException as err:
-                fancy_logger.get().error(
-                    "Error while processing message: %s", err, exc_info=True
+        # If the message is hidden, ignore it and move on. We do this here instead of in
+        # decide_to_respond, in case the user is using something like PluralKit or
+        # Tupperbox and the original message (which was deleted) began with a different
+        # sequence. Because we wait to accumulate messages, this ensures the deleted
+        # message doesn't trigger a response to whatever the latest message ends up being.
+        if not guaranteed_response and message.body_text.startswith(self.ignore_prefixes):
+            return
+
+        try:
+            async with channel.typing():
+                await self._handle_response(
+                    message,
+                    raw_message,
+                    is_summon_in_public_channel,
                 )
+        except discord.DiscordException as err:
+            fancy_logger.get().error(
+                "Error while processing message: %s", err, exc_info=True
+            )
 
     async def _get_image_descriptions(
         self,
@@ -428,30 +683,64 @@ class DiscordBot(discord.Client):
         images = []
         image_descriptions = []
         if self.vision_client:
-            if self.vision_client.fetch_urls:
-                urls = self.vision_client.url_extractor.findall(raw_message.content)
-                images += urls
-            if raw_message.attachments:
-                for attachment in raw_message.attachments:
-                    if attachment.content_type and attachment.content_type.startswith("image/"):
-                        try:
-                            # Open our image as a PIL Image object
-                            image = Image.open(io.BytesIO(await attachment.read()))
-                            # Pre-process the image for the Vision API
-                            image = self.vision_client.preprocess_image(image)
-                            images.append(image)
-                        except Exception as e:
-                            fancy_logger.get().error(
-                                "Error pre-processing image: %s", e, exc_info=True
-                            )
-            for image in images:
-                try:
-                    fancy_logger.get().debug("Getting image description...")
-                    description = await self.vision_client.get_image_description(image)
-                    if description:
-                        image_descriptions.append(description)
-                except Exception as e:
-                    fancy_logger.get().error("Error processing image: %s", e, exc_info=True)
+            # every URL we look for starts with "http", and most messages
+            # have none, so a substring check saves running the regex
+            if self._find_image_urls and "http" in raw_message.content:
+                images += self._find_image_urls(raw_message.content)
+            # download all image attachments at once, rather than one by one
+            image_attachments = [
+                attachment
+                for attachment in raw_message.attachments
+                if attachment.content_type
+                and attachment.content_type.startswith("image/")
+            ]
+            attachment_data = await asyncio.gather(
+                *(attachment.read() for attachment in image_attachments),
+                return_exceptions=True,
+            )
+            # decoding and resizing images is CPU-bound, so do it in worker
+            # threads (or processes, if configured) where it won't hold up
+            # the event loop
+            loop = asyncio.get_running_loop()
+            preprocessed_images = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        self._image_pool,
+                        vision.decode_and_preprocess_image,
+                        data,
+                        self.vision_client.max_image_size,
+                    )
+                    for data in attachment_data
+                    if not isinstance(data, BaseException)
+                ),
+                return_exceptions=True,
+            )
+            for data in attachment_data:
+                if isinstance(data, BaseException):
+                    fancy_logger.get().error(
+                        "Error downloading image: %s", data, exc_info=data
+                    )
+            for image in preprocessed_images:
+                if isinstance(image, BaseException):
+                    fancy_logger.get().error(
+                        "Error pre-processing image: %s", image, exc_info=image
+                    )
+                else:
+                    images.append(image)
+            if images:
+                fancy_logger.get().debug("Getting %d image description(s)...", len(images))
+            # and likewise ask for all of the descriptions at once
+            descriptions = await asyncio.gather(
+                *(self.vision_client.get_image_description(image) for image in images),
+                return_exceptions=True,
+            )
+            for description in descriptions:
+                if isinstance(description, BaseException):
+                    fancy_logger.get().error(
+                        "Error processing image: %s", description, exc_info=description
+                    )
+                elif description:
+                    image_descriptions.append(description)
 
         return image_descriptions
 
@@ -478,23 +767,33 @@ class DiscordBot(discord.Client):
         #if image_prompt:
         #    is_image_coming = await self.image_generator.try_session()
 
-        # Determine if there are images and get descriptions (if Vision is enabled)
-        image_descriptions = await self._get_image_descriptions(raw_message)
+        # Determine if there are images and get descriptions (if Vision is enabled).
+        # This runs alongside fetching the message history, later on.
+        image_descriptions = asyncio.create_task(
+            self._get_image_descriptions(raw_message)
+        )
 
         # If the message is essentially devoid of content we can handle, abort response.
-        if message.is_empty() and not image_descriptions:
+        if message.is_empty() and not await image_descriptions:
             return
 
-        result = await self._send_text_response(
-            message=message,
-            raw_message=raw_message,
-            image_descriptions=image_descriptions,
-            image_requested=is_image_coming,
-            is_summon_in_public_channel=is_summon_in_public_channel,
-        )
+        try:
+            result = await self._send_text_response(
+                message=message,
+                raw_message=raw_message,
+                image_descriptions=image_descriptions,
+                image_requested=is_image_coming,
+                is_summon_in_public_channel=is_summon_in_public_channel,
+            )
+        except BaseException:
+            # nothing will be waiting on the descriptions now, so don't
+            # leave their vision requests running
+            image_descriptions.cancel()
+            raise
         if not result:
             # we failed to create a thread that the user could
             # read our response in, so we're done here.  Abort!
+            image_descriptions.cancel()
             return
         message_task, response_channel = result
 
@@ -516,28 +815,51 @@ class DiscordBot(discord.Client):
                 response_channel=response_channel,
             )
 
-        response_tasks = [
-            task for task in [message_task, image_task] if task
-        ]
+        # gather propagates the first exception from any of the tasks.
+        # Usually there's only the text response, so just await that
+        # directly instead of wrapping it in a gather future.
+        try:
+            if image_task is None:
+                await message_task
+            else:
+                await asyncio.gather(message_task, image_task)
+        except Exception as err:
+            fancy_logger.get().error(
+                "Exception while sending response: %s", err, exc_info=True
+            )
+            raise
 
-        # Use asyncio.gather instead of asyncio.wait to properly handle exceptions
-        if response_tasks:
-            done, _pending = await asyncio.wait(response_tasks, return_when=asyncio.ALL_COMPLETED)
-            # Check for exceptions in the tasks that have completed
-            for task in done:
-                if task.exception():
-                    fancy_logger.get().error(
-                        "Exception while running %s. Response: %s",
-                        task.get_coro(),
-                        task.exception(),
-                        stack_info=True,
-                    )
-                    raise task.exception()
+    def _get_impersonation_stopping_strings(
+        self, recent_members: typing.Tuple[str, ...]
+    ) -> typing.List[str]:
+        """
+        Returns the stopping strings which keep the AI from speaking as any of
+        the given members.  Consecutive responses in a channel usually see the
+        same members, so the last result is kept and reused.
+        """
+        if self._last_impersonation_stopping_strings[0] == recent_members:
+            return self._last_impersonation_stopping_strings[1]
+
+        add_prompt_prefix = self._impersonation_adds_prompt_prefix
+        add_name = self._impersonation_adds_name
+        template_store = self.template_store
+        format_user_name = prompt_generator.format_user_name
+
+        stopping_strings = []
+        for member_name in recent_members:
+            user_name = format_user_name(template_store, member_name)
+            if add_prompt_prefix:
+                stopping_strings.append(_user_prompt_prefix(template_store, user_name))
+            if add_name:
+                stopping_strings.append("\n" + _canonicalized_name(user_name))
+
+        self._last_impersonation_stopping_strings = (recent_members, stopping_strings)
+        return stopping_strings
 
     async def _generate_response(
         self,
         message: types.GenericMessage,
-        recent_messages: typing.AsyncIterator,
+        recent_messages: typing.List[types.GenericMessage],
         image_descriptions: typing.List[str],
         image_requested: typing.Optional[bool],
         response_channel: discord.abc.Messageable,
@@ -551,11 +873,8 @@ class DiscordBot(discord.Client):
         """
         fancy_logger.get().debug("Generating prompt...")
 
-        # Convert the recent messages into a list to modify it
-        recent_messages_list = [msg async for msg in recent_messages]
-
-        # Attach any image descriptions to the user's message
-        if image_descriptions:
+        # Attach any image descriptions to the user's message, unless it's hidden
+        if image_descriptions and not message.body_text.startswith(self.ignore_prefixes):
             image_received = self.template_store.format(
                 templates.Templates.PROMPT_IMAGE_RECEIVED,
                 {
@@ -563,24 +882,16 @@ class DiscordBot(discord.Client):
                     templates.TemplateToken.USER_NAME: message.author_name,
                 },
             )
-            description_text = "\n".join(image_received + desc for desc in image_descriptions)
-            skip = False
-            for msg in recent_messages_list:
-                for ignore_prefix in self.ignore_prefixes:
-                    if message.body_text.startswith(ignore_prefix):
-                        skip = True
-                        break
-                    skip = False
-                if not skip and msg.author_id == message.author_id:
+            # prefix every description with the image_received text, one per line
+            description_text = image_received + ("\n" + image_received).join(
+                image_descriptions
+            )
+            author_id = message.author_id
+            for msg in recent_messages:
+                if msg.author_id == author_id:
                     # Append the image descriptions to the body text of the user's last message
                     msg.body_text += "\n" + description_text
                     break
-        # Convert the list back into an async generator
-        async def _list_to_async_gen(lst: typing.List) -> typing.AsyncGenerator:
-            for item in lst:
-                yield item
-        recent_messages_async_gen = _list_to_async_gen(recent_messages_list)
-
         # Generate the prompt prefix using the modified recent messages
         if isinstance(response_channel, (discord.abc.GuildChannel, discord.Thread)):
             guild_name = response_channel.guild.name
@@ -593,55 +904,27 @@ class DiscordBot(discord.Client):
             response_channel_name = "None"
         prompt_prefix = await self.prompt_generator.generate(
             bot_user_id=self.bot_user_id,
-            message_history=recent_messages_async_gen,
+            message_history=recent_messages,
             image_requested=image_requested,
             guild_name=guild_name,
             response_channel=response_channel_name,
         )
         response_stat = self.response_stats.log_request_arrived(prompt_prefix)
 
-        stopping_strings = []
-        if self.prevent_impersonation:
+        stopping_strings: typing.List[str] = []
+        if self.prevent_impersonation and recent_messages:
             # Populate a list of stopping strings using the display names of the members
-            # who posted most recently, up to the history limit. We do this with a list
-            # comprehension which both preserves order, and has linear time complexity
-            # vs. quadratic time complexity for loops. We also use a dictionary conversion
-            # to de-duplicate instead of checking list membership, as this has constant
-            # time complexity vs. linear and also preserves order.
-            recent_members = dict.fromkeys([msg.author_name for msg in recent_messages_list])
-            recent_members.pop(self.user.display_name, None) # we don't want our own name
-            recent_members = recent_members.keys()
-
-            # utility functions to avoid code-duplication and only evaluate when required
-            # avoids populating unneeded variables and improves performance very slightly
-            def _get_user_prompt_prefix(user_name: str) -> str:
-                return self.template_store.format(
-                    templates.Templates.USER_PROMPT_HISTORY_BLOCK,
-                    {
-                        templates.TemplateToken.USER_NAME: user_name,
-                        templates.TemplateToken.MESSAGE: "",
-                    },
-                ).strip()
-            def _get_canonicalized_name(user_name: str) -> str:
-                name = emoji.replace_emoji(user_name, "")
-                canonicalized_name = name.split()[0].strip().capitalize()
-                return canonicalized_name if len(canonicalized_name) >= 3 else name
-
-            # TODO: O(n^2) time complexity... figure out how to make this faster
-            for member_name in recent_members:
-                user_name = self.template_store.format(
-                    templates.Templates.USER_NAME,
-                    {
-                        templates.TemplateToken.NAME: member_name,
-                    },
-                )
-                if self.prevent_impersonation == "standard":
-                    stopping_strings.append(_get_user_prompt_prefix(user_name))
-                elif self.prevent_impersonation == "aggressive":
-                    stopping_strings.append("\n" + _get_canonicalized_name(user_name))
-                elif self.prevent_impersonation == "comprehensive":
-                    stopping_strings.append(_get_user_prompt_prefix(user_name))
-                    stopping_strings.append("\n" + _get_canonicalized_name(user_name))
+            # who posted most recently, up to the history limit. A dict comprehension
+            # de-duplicates the names in a single pass while preserving their order.
+            own_name = self.user.display_name  # we don't want our own name
+            recent_members = tuple(
+                {
+                    msg.author_name: None
+                    for msg in recent_messages
+                    if msg.author_name != own_name
+                }
+            )
+            stopping_strings = self._get_impersonation_stopping_strings(recent_members)
 
         fancy_logger.get().debug("Generating text response...")
         if as_string:
@@ -665,7 +948,7 @@ class DiscordBot(discord.Client):
         self,
         message: types.GenericMessage,
         raw_message: discord.Message,
-        image_descriptions: typing.List[str],
+        image_descriptions: typing.Awaitable[typing.List[str]],
         image_requested: typing.Optional[bool],
         is_summon_in_public_channel: bool,
     ) -> typing.Optional[typing.Tuple[asyncio.Task, discord.abc.Messageable]]:
@@ -728,7 +1011,7 @@ class DiscordBot(discord.Client):
         self,
         message: types.GenericMessage,
         raw_message: discord.Message,
-        image_descriptions: typing.List[str],
+        image_descriptions: typing.Awaitable[typing.List[str]],
         image_requested: typing.Optional[bool],
         is_summon_in_public_channel: bool,
         response_channel: discord.abc.Messageable,
@@ -755,11 +1038,14 @@ class DiscordBot(discord.Client):
                 reference = raw_message.to_reference()
         ignore_all_until_message_id = message.message_id
 
-        recent_messages = await self._recent_messages_following_thread(
-            channel=response_channel,
-            num_history_lines=self.prompt_generator.history_lines,
-            stop_before_message_id=repeated_id,
-            ignore_all_until_message_id=ignore_all_until_message_id,
+        recent_messages, image_descriptions_list = await asyncio.gather(
+            self._recent_messages_following_thread(
+                channel=response_channel,
+                num_history_lines=self.prompt_generator.history_lines,
+                stop_before_message_id=repeated_id,
+                ignore_all_until_message_id=ignore_all_until_message_id,
+            ),
+            image_descriptions,
         )
 
         # will be set to true when we abort the response because:
@@ -770,7 +1056,7 @@ class DiscordBot(discord.Client):
         response, response_stat = await self._generate_response(
             message=message,
             recent_messages=recent_messages,
-            image_descriptions=image_descriptions,
+            image_descriptions=image_descriptions_list,
             image_requested=image_requested,
             response_channel=response_channel,
             as_string=self.dont_split_responses and not self.stream_responses,
@@ -806,7 +1092,7 @@ class DiscordBot(discord.Client):
                         new_response = ""
                         # Split lines and preserve our splitting characters using regex split
                         # with a capturing group to return the split character(s) in the list
-                        lines = re.split(r"([" + self.line_split_pattern + r"]+)", response)
+                        lines = self._line_split_regex.split(response)
                         lines = response
                         for line in lines:
                             # Sometimes the trailing space at the end of a sentence is kept,
@@ -854,6 +1140,11 @@ class DiscordBot(discord.Client):
                 # in a new message each time, notifying the channel.
                 else:
                     last_sent_message = None
+                    # Space sends out by the rate limit, counting the time spent
+                    # generating and sending towards it, rather than sleeping the
+                    # full interval after every message.
+                    loop = asyncio.get_running_loop()
+                    next_send_time = 0.0
                     async for sentence in response:
                         if len(sentence) > self.message_character_limit:
                             # idk how the hell we might get here but best to consider it
@@ -864,6 +1155,10 @@ class DiscordBot(discord.Client):
                                 len(sentence) - self.message_character_limit
                             )
                             sentence = sentence[:self.message_character_limit]
+                        delay = next_send_time - loop.time()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                        next_send_time = loop.time() + self.stream_responses_speed_limit
                         (
                             sent_message,
                             abort_response,
@@ -883,7 +1178,6 @@ class DiscordBot(discord.Client):
                         if abort_response:
                             aborted_by_us = True
                             break
-                        await asyncio.sleep(self.stream_responses_speed_limit)
 
         except discord.DiscordException as err:
             fancy_logger.get().error("Error while sending message: %s", err, exc_info=True)
@@ -988,14 +1282,16 @@ class DiscordBot(discord.Client):
         repeated_id = self.repetition_tracker.get_throttle_message_id(
             channel.id
         )
-        recent_messages = await self._recent_messages_following_thread(
-            channel=channel,
-            num_history_lines=self.prompt_generator.history_lines,
-            stop_before_message_id=repeated_id,
-            ignore_all_until_message_id=message.message_id,
-            exclude_ignored_message=True,
+        recent_messages, image_descriptions = await asyncio.gather(
+            self._recent_messages_following_thread(
+                channel=channel,
+                num_history_lines=self.prompt_generator.history_lines,
+                stop_before_message_id=repeated_id,
+                ignore_all_until_message_id=message.message_id,
+                exclude_ignored_message=True,
+            ),
+            self._get_image_descriptions(raw_message),
         )
-        image_descriptions = await self._get_image_descriptions(raw_message)
         response, response_stat = await self._generate_response(
             message=message,
             recent_messages=recent_messages,
@@ -1061,56 +1357,94 @@ class DiscordBot(discord.Client):
         Renders a streaming response into a message by editing it with updated
         contents each time a new group of response tokens is received.
         """
-        buffer = ""
-        response = ""
+        # The filter works line by line, so once a line is complete its
+        # filtered text can't change.  Keep the filtered complete lines of the
+        # current message, and only re-filter the raw tokens received since.
+        filtered_lines = ""
+        chunks: typing.List[str] = []
+        # what we last sent, since Discord may trim the message content
+        last_response = ""
         last_message = existing_message
         sent_message_count = 0
 
-        async for tokens in response_iterator:
-            if not tokens:
-                continue
-            buffer, abort_response = self._filter_immersion_breaking_lines(buffer + tokens)
-            # If we would exceed the character limit, post what we have and start a new message
-            if len(buffer) > self.message_character_limit:
-                fancy_logger.get().debug(
-                    "Response exceeded %d character limit! Posting current "
-                    + "message and continuing in a new message.",
-                    self.message_character_limit
-                )
-                buffer = ""
-                response = ""
-                reference = last_message
-                last_message = None
-            response, abort_response = self._filter_immersion_breaking_lines(response + tokens)
-
-            # don't send an empty message
-            if not response:
-                continue
+        # these are used for every group of tokens, so look them up once
+        line_split_pattern = self.line_split_pattern
+        character_limit = self.message_character_limit
+        filter_lines = self._filter_immersion_breaking_lines
+        log_response_part = response_stat.log_response_part
 
-            # if we are aborting a response, we want to at least post
-            # the valid parts, so don't abort quite yet.
-            if not last_message:
-                last_message = await response_channel.send(
-                    response,
-                    allowed_mentions=allowed_mentions,
-                    suppress_embeds=True,
-                    reference=reference,
-                )
-                sent_message_count += 1
-            else:
-                last_message = await last_message.edit(
-                    content=response,
-                    allowed_mentions=allowed_mentions,
-                    suppress=True,
-                )
+        try:
+            async for tokens in response_iterator:
+                if not tokens:
+                    continue
+                chunks.append(tokens)
+                pending = "".join(chunks)
+                # the end of the last run of line split characters, as long as
+                # there's more text after it (otherwise the run may continue)
+                line_end = 1 + max(pending.rfind(char) for char in line_split_pattern)
+                abort_response = False
+                if 0 < line_end < len(pending):
+                    complete_lines, abort_response = filter_lines(pending[:line_end])
+                    filtered_lines += complete_lines
+                    pending = pending[line_end:]
+                    chunks = [pending]
+                if abort_response:
+                    response = filtered_lines
+                else:
+                    filtered_tail, abort_response = filter_lines(pending)
+                    response = filtered_lines + filtered_tail
+                # If we would exceed the character limit, post what we have and
+                # start a new message
+                if len(response) > character_limit:
+                    fancy_logger.get().debug(
+                        "Response exceeded %d character limit! Posting current "
+                        + "message and continuing in a new message.",
+                        character_limit
+                    )
+                    filtered_lines = ""
+                    chunks = [tokens]
+                    reference = last_message
+                    last_message = None
+                    response, abort_response = filter_lines(tokens)
+
+                # don't send an empty message, but stop if the filter says so
+                if not response:
+                    if abort_response:
+                        break
+                    continue
 
-            # we want to abort the response only after we've sent any valid
-            # messages, and potentially removed any partial immersion-breaking
-            # lines that we posted when they were in the process of being received.
-            if abort_response:
-                break
+                # if we are aborting a response, we want to at least post
+                # the valid parts, so don't abort quite yet.
+                if not last_message:
+                    last_message = await response_channel.send(
+                        response,
+                        allowed_mentions=allowed_mentions,
+                        suppress_embeds=True,
+                        reference=reference,
+                    )
+                    sent_message_count += 1
+                elif response != last_response:
+                    # Discord only takes whole-message edits, so at least skip
+                    # the ones that wouldn't change anything, e.g. when all of
+                    # the new tokens were filtered out
+                    last_message = await last_message.edit(
+                        content=response,
+                        allowed_mentions=allowed_mentions,
+                        suppress=True,
+                    )
+                last_response = response
 
-            response_stat.log_response_part()
+                # we want to abort the response only after we've sent any valid
+                # messages, and potentially removed any partial immersion-breaking
+                # lines that we posted when they were in the process of being received.
+                if abort_response:
+                    break
+
+                log_response_part()
+        finally:
+            # stop the request now, rather than leaving the AI generating tokens
+            # nobody will see if we aborted part way through
+            await _close_response(response_iterator)
 
         if last_message:
             self.repetition_tracker.log_message(
@@ -1120,6 +1454,10 @@ class DiscordBot(discord.Client):
 
         return last_message, sent_message_count
 
+    # how many finished sentences may wait to be posted before we stop
+    # reading more of the response from the AI
+    SENTENCE_QUEUE_SIZE = 4
+
     async def _render_response_by_sentence(
         self,
         response_iterator: typing.AsyncIterator[str],
@@ -1134,26 +1472,12 @@ class DiscordBot(discord.Client):
         with the updated contents every response streaming interval.
         """
         response = ""
+        unsent = False
         last_message = existing_message
         sent_message_count = 0
 
-        async for sentence in response_iterator:
-            sentence, abort_response = self._filter_immersion_breaking_lines(sentence)
-            if not sentence:
-                continue
-            sentence = sentence.strip(" ") + " "
-            # If we would exceed the character limit, start a new message
-            if len(response + sentence) > self.message_character_limit:
-                fancy_logger.get().debug(
-                    "Response exceeded %d character limit! Posting current "
-                    + "message and continuing in a new message.",
-                    self.message_character_limit
-                )
-                response = ""
-                reference = last_message
-                last_message = None
-            response += sentence
-
+        async def send_response():
+            nonlocal last_message, sent_message_count
             if not last_message:
                 last_message = await response_channel.send(
                     response,
@@ -1169,14 +1493,75 @@ class DiscordBot(discord.Client):
                     suppress=True,
                 )
 
-            if abort_response:
-                break
+        # Sentences are pulled from the AI by a separate task, so that any which
+        # arrive while we wait out the rate limit are posted in a single edit.
+        # The queue is bounded, so that a slow Discord holds the AI stream back.
+        sentence_queue: asyncio.Queue = asyncio.Queue(maxsize=self.SENTENCE_QUEUE_SIZE)
+        queue_task = asyncio.create_task(
+            _queue_response_parts(response_iterator, sentence_queue)
+        )
+        try:
+            finished = False
+            abort_response = False
+            while not (finished or abort_response):
+                sentences = [await sentence_queue.get()]
+                while not sentence_queue.empty():
+                    sentences.append(sentence_queue.get_nowait())
+
+                batch_parts = 0
+                for sentence in sentences:
+                    if sentence is None:
+                        finished = True
+                        break
+                    if isinstance(sentence, Exception):
+                        # post what we have before giving up
+                        if unsent:
+                            await send_response()
+                        raise sentence
+                    sentence, abort_response = self._filter_immersion_breaking_lines(
+                        sentence
+                    )
+                    if sentence:
+                        sentence = sentence.strip(" ") + " "
+                        # If we would exceed the character limit, start a new message
+                        if len(response + sentence) > self.message_character_limit:
+                            fancy_logger.get().debug(
+                                "Response exceeded %d character limit! Posting current "
+                                + "message and continuing in a new message.",
+                                self.message_character_limit
+                            )
+                            if unsent:
+                                await send_response()
+                            response = ""
+                            reference = last_message
+                            last_message = None
+                        response += sentence
+                        unsent = True
+                    if abort_response:
+                        break
+                    if sentence:
+                        batch_parts += 1
 
-            response_stat.log_response_part()
-            # Wait an interval so we don't hit the rate-limit. This is not done
-            # in the ooba_client because the method may be used for other things
-            # that don't require waiting.
-            await asyncio.sleep(self.stream_responses_speed_limit)
+                if not unsent:
+                    continue
+                await send_response()
+                unsent = False
+                # count every sentence we posted, not just the edit they shared
+                for _ in range(batch_parts):
+                    response_stat.log_response_part()
+                if abort_response:
+                    break
+                if finished:
+                    break
+                # Wait an interval so we don't hit the rate-limit. This is not done
+                # in the ooba_client because the method may be used for other things
+                # that don't require waiting.
+                await asyncio.sleep(self.stream_responses_speed_limit)
+        finally:
+            # wait for the task to finish closing the response, so that
+            # happens before we return rather than at some later point
+            queue_task.cancel()
+            await asyncio.gather(queue_task, return_exceptions=True)
 
         if last_message:
             self.repetition_tracker.log_message(
@@ -1203,29 +1588,49 @@ class DiscordBot(discord.Client):
         if not self.use_immersion_breaking_filter:
             return text, False
 
-        # Split by our line split pattern, preserving the split characters in the list.
-        # This makes it easy to re-join them later, without having to guess which
-        # character we split at.
-        lines = re.split(r"([" + self.line_split_pattern + r"]+)", text)
-        good_lines = []
+        # Most streamed updates are a fragment of a single sentence, which
+        # doesn't need splitting up.
+        find_sentence_break = self._sentence_break_regex.search
+        single_sentence = not find_sentence_break(text)
+        if single_sentence:
+            lines = [text]
+        else:
+            # Split by our line split pattern, preserving the split characters in
+            # the list. This makes it easy to re-join them later, without having to
+            # guess which character we split at.
+            lines = self._line_split_regex.split(text)
+        # sentences and the separators between them, joined once at the end
+        good_parts = []
         abort_response = False
 
+        # these are checked against every sentence, so look them up once
+        line_split_pattern = self.line_split_pattern
+        bot_prompt_block = self.prompt_generator.bot_prompt_block
+        match_username_message = self._username_message_pattern.match
+        stop_marker_regex = self._stop_marker_regex
+
         for line in lines:
-            if not line.strip(self.line_split_pattern):
+            if not line.strip(line_split_pattern):
                 # If our line is composed of only split characters, just append it to
-                # good_lines and move on.
-                good_lines.append(line)
+                # good_parts and move on.
+                good_parts.append(line)
                 continue
-            # Split the line by our pysbd segmenter to get individual sentences
-            sentences = self.sentence_splitter.segment(line)
-            good_sentences = []
+            # Split the line by our pysbd segmenter to get individual sentences.
+            # pysbd is nearly all of the filter's running time, so skip it for
+            # lines which it couldn't split anyway.  pysbd drops any leading
+            # whitespace, including non-ASCII spaces, so do the same here.
+            if single_sentence or not find_sentence_break(line):
+                sentences = [line.lstrip()]
+            else:
+                sentences = self.sentence_splitter.segment(line)
+            line_start = len(good_parts)
 
             for sentence in sentences:
                 sentence = sentence.strip(" ") + " "
 
                 # if the AI gives itself a second line, just ignore
                 # the line instruction and continue
-                if self.prompt_generator.bot_prompt_block in sentence:
+                if bot_prompt_block in sentence:
                     fancy_logger.get().warning(
                         "Filtered out %s from response, continuing.",
                         sentence,
@@ -1234,45 +1639,10 @@ class DiscordBot(discord.Client):
 
                 # hack: abort response if it looks like the AI is
                 # continuing the conversation as someone else
-                name_identifier = "%%%%%%%%NAME%%%%%%%%"
-                username_pattern = self.template_store.format(
-                    templates.Templates.USER_PROMPT_HISTORY_BLOCK,
-                    {
-                        templates.TemplateToken.USER_NAME: self.template_store.format(
-                            templates.Templates.USER_NAME,
-                            {
-                                templates.TemplateToken.NAME: name_identifier,
-                            },
-                        ),
-                        templates.TemplateToken.MESSAGE: "",
-                    },
-                ).strip("\n")
-                # Discord usernames are 2-32 characters long, and can only contain special
-                # characters '_' and '.' but display names are 1-32 characters long and can
-                # contain almost anything, so we try to account for the more permissive option.
-                # Hopefully results in fewer false positives than matching anything. Using a
-                # prompt history block like "[{USER_NAME}]: {MESSAGE}" will work better.
-                username_pattern = re.escape(username_pattern).replace(
-                    name_identifier, r"[\S ]{1,32}"
-                )
-                message_pattern = re.compile(r'^(' + username_pattern + r')(.*)$')
-                match = message_pattern.match(sentence)
+                match = match_username_message(sentence)
                 if match:
                     username_sequence, remaining_text = match.groups()
-                    ai_name_prompt = self.template_store.format(
-                        templates.Templates.BOT_PROMPT_HISTORY_BLOCK,
-                        {
-                            templates.TemplateToken.BOT_NAME: self.template_store.format(
-                                templates.Templates.BOT_NAME,
-                                {
-                                    templates.TemplateToken.NAME: self.persona.ai_name,
-                                },
-                            ),
-                            templates.TemplateToken.MESSAGE: "",
-                        },
-                    ).strip("\n")
-
-                    if username_sequence in ai_name_prompt:
+                    if username_sequence in self._ai_name_prompt:
                         # If the username matches the bot's name, trim the username portion
                         # and keep the remaining text
                         fancy_logger.get().warning(
@@ -1289,32 +1659,67 @@ class DiscordBot(discord.Client):
                         break  # Break out of the for-loop processing sentences
 
                 # look for partial stop markers within a sentence
-                for marker in self.stop_markers:
-                    if marker in sentence:
-                        keep_part, removed = sentence.split(marker, 1)
-                        fancy_logger.get().warning(
-                            "Filtered out '%s' from response, aborting", removed
-                        )
-                        if keep_part:
-                            good_sentences.append(keep_part)
-                        abort_response = True
-                        break
+                marker_match = (
+                    stop_marker_regex.search(sentence) if stop_marker_regex else None
+                )
+                if marker_match:
+                    fancy_logger.get().warning(
+                        "Filtered out '%s' from response, aborting",
+                        sentence[marker_match.end() :],
+                    )
+                    abort_response = True
 
                 if abort_response:
                     break
 
                 # filter out sentences that are entirely made of whitespace/newlines
                 if sentence.strip():
-                    good_sentences.append(sentence)
+                    if len(good_parts) > line_start:
+                        good_parts.append(" ")  # Re-add the stripped whitespace
+                    good_parts.append(sentence)
 
             if abort_response:
+                # the line that aborted the response is dropped entirely
+                del good_parts[line_start:]
                 break
 
-            good_line = " ".join(good_sentences) # Re-add the stripped whitespace
-            if good_line:
-                good_lines.append(good_line)
+        return ("".join(good_parts), abort_response)
+
+    def _get_user_id_to_name_resolver(
+        self, message: discord.Message
+    ) -> typing.Callable[[typing.Match[str]], str]:
+        """
+        Returns the function which turns user ID mentions in the given
+        message into names.  Guild and group DM resolvers look members
+        up when they're called, so those are kept.  Every channel and
+        thread in a guild shares its guild's resolver, so short-lived
+        threads don't each leave one behind.
+        """
+        channel = message.channel
+        if isinstance(channel, (discord.abc.GuildChannel, discord.Thread)):
+            # snowflake IDs are unique across guilds and channels, so both
+            # can share the same dict
+            resolver_id = channel.guild.id
+        elif isinstance(channel, discord.GroupChannel):
+            resolver_id = channel.id
+        else:
+            # DMs, and anything we shouldn't ever end up with.  This takes the
+            # author's current name, so don't keep it.
+            return discord_utils.dm_user_id_to_name(
+                self.bot_user_id,
+                self.persona.ai_name,
+                message.author.display_name,
+            )
 
-        return ("".join(good_lines), abort_response)
+        fn_user_id_to_name = self._user_id_to_name_resolvers.get(resolver_id)
+        if fn_user_id_to_name:
+            return fn_user_id_to_name
+        if isinstance(channel, discord.GroupChannel):
+            fn_user_id_to_name = discord_utils.group_user_id_to_name(channel)
+        else:
+            fn_user_id_to_name = discord_utils.guild_user_id_to_name(channel.guild)
+        self._user_id_to_name_resolvers[resolver_id] = fn_user_id_to_name
+        return fn_user_id_to_name
 
     async def _filter_history_message(
       self,
@@ -1341,50 +1746,34 @@ class DiscordBot(discord.Client):
         if stop_before_message_id and message.id == stop_before_message_id:
             return (None, False)
 
+        # reject messages using only the raw discord message, so we don't
+        # bother converting messages we're going to throw away
+        from_bot = message.author.id == self.bot_user_id
+
+        # hack: use the suppress_embeds=True flag to indicate
+        # that this message is one we generated as part of a text
+        # response, as opposed to an image or application message
+        if from_bot and not message.flags.suppress_embeds:
+            # this is a message generated by our image generator
+            return (None, True)
+
+        if message.content.startswith(self.ignore_prefixes):
+            return (None, True)
+
         generic_message = discord_utils.discord_message_to_generic_message(message)
 
-        if generic_message.author_id == self.bot_user_id:
+        if from_bot:
             # make sure the AI always sees its persona name
             # in the transcript, even if the chat program
             # has it under a different account name
             generic_message.author_name = self.persona.ai_name
 
-            # hack: use the suppress_embeds=True flag to indicate
-            # that this message is one we generated as part of a text
-            # response, as opposed to an image or application message
-            if not message.flags.suppress_embeds:
-                # this is a message generated by our image generator
-                return (None, True)
-
-        for ignore_prefix in self.ignore_prefixes:
-            if generic_message.body_text.startswith(ignore_prefix):
-                return (None, True)
-
-        if isinstance(message.channel, discord.DMChannel):
-            fn_user_id_to_name = discord_utils.dm_user_id_to_name(
-                self.bot_user_id,
-                self.persona.ai_name,
-                message.author.display_name,
-            )
-        elif isinstance(message.channel, (discord.abc.GuildChannel, discord.Thread)):
-            fn_user_id_to_name = discord_utils.guild_user_id_to_name(
-                message.channel.guild,
-            )
+        if message.guild:
             await discord_utils.replace_channel_mention_ids_with_names(
                 self,
                 generic_message,
             )
-        elif isinstance(message.channel, discord.GroupChannel):
-            fn_user_id_to_name = discord_utils.group_user_id_to_name(
-                message.channel,
-            )
-        else:
-            # we shouldn't ever end up here... give it a function anyway
-            fn_user_id_to_name = discord_utils.dm_user_id_to_name(
-                self.bot_user_id,
-                self.persona.ai_name,
-                message.author.display_name,
-            )
+        fn_user_id_to_name = self._get_user_id_to_name_resolver(message)
 
         discord_utils.replace_user_mention_ids_with_names(
             generic_message,
@@ -1481,6 +1870,7 @@ class DiscordBot(discord.Client):
     # penalty to making this somewhat large.  But still, we want
     # to keep it reasonable.
     MESSAGE_HISTORY_LOOKBACK_BONUS = 20
+    MESSAGE_HISTORY_LOOKBACK_FACTOR = 1.5
 
     async def _recent_messages_following_thread(
         self,
@@ -1489,12 +1879,24 @@ class DiscordBot(discord.Client):
         ignore_all_until_message_id: typing.Optional[int],
         num_history_lines: int,
         exclude_ignored_message: bool = False,
-    ) -> typing.AsyncIterator[types.GenericMessage]:
+    ) -> typing.List[types.GenericMessage]:
         """
-        Gets an async iterator of the chat history, between the limits provided.
+        Gets the chat history, newest first, between the limits provided.
         """
-        max_messages_to_check = num_history_lines + self.MESSAGE_HISTORY_LOOKBACK_BONUS
-        history = channel.history(limit=max_messages_to_check)
+        # with no history wanted, don't fetch a page of it only to discard it
+        if num_history_lines <= 0:
+            return []
+        # with a lot of history, a fixed bonus can be used up by filtered messages,
+        # so allow for a proportion of them as well
+        max_messages_to_check = max(
+            num_history_lines + self.MESSAGE_HISTORY_LOOKBACK_BONUS,
+            int(num_history_lines * self.MESSAGE_HISTORY_LOOKBACK_FACTOR),
+        )
+        # served from discord.py's message cache where possible, which on_message,
+        # edit and delete events already keep up to date for us
+        history = discord_utils.recent_channel_messages(
+            self, channel, max_messages_to_check
+        )
         result = self._filtered_history_iterator(
             history,
             limit=num_history_lines,
@@ -1503,4 +1905,4 @@ class DiscordBot(discord.Client):
             exclude_ignored_message=exclude_ignored_message,
         )
 
-        return result
+        return [message async for message in result]
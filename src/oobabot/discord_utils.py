@@ -8,6 +8,7 @@ Discord library.
 """
 
 
+import asyncio
 import base64
 import functools
 import os
@@ -23,6 +24,14 @@ from oobabot import types
 FORBIDDEN_CHARACTERS = r"[\n\r\t]"
 FORBIDDEN_CHARACTERS_PATTERN = re.compile(FORBIDDEN_CHARACTERS)
 
+# it looks like normal IDs are 18 digits.  But give it some
+# wiggle room in case things change in the future.
+# e.g.: <@009999999999999999>, or <@!009999999999999999> from
+# older clients mentioning someone's nickname
+USER_MENTION_PATTERN = re.compile(r"<@!?(\d{16,20})>")
+# it looks like channel IDs are 19 digits long
+CHANNEL_MENTION_PATTERN = re.compile(r"<#(\d{17,21})>")
+
 
 def get_channel_name(channel: discord.abc.Messageable) -> str:
     if isinstance(channel, discord.Thread):
@@ -95,19 +104,9 @@ def replace_user_mention_ids_with_names(
     Replace user ID mentions with the user's chosen display
     name in the given guild (aka server)
     """
-    # it looks like normal IDs are 18 digits.  But give it some
-    # wiggle room in case things change in the future.
-    # e.g.: <@009999999999999999>
-    at_mention_pattern = r"<@(\d{16,20})>"
-    while True:
-        match = re.search(at_mention_pattern, generic_message.body_text)
-        if not match:
-            break
-        generic_message.body_text = (
-            generic_message.body_text[:match.start()]
-            + fn_user_id_to_name(match)
-            + generic_message.body_text[match.end():]
-        )
+    generic_message.body_text = USER_MENTION_PATTERN.sub(
+        fn_user_id_to_name, generic_message.body_text
+    )
 
 
 async def replace_channel_mention_ids_with_names(
@@ -115,28 +114,69 @@ async def replace_channel_mention_ids_with_names(
     generic_message: types.GenericMessage,
 ):
     """
-    Replace user ID mentions with the user's chosen display
-    name in the given guild (aka server)
+    Replace channel ID mentions with the channel's name
     """
-    # it looks like IDs are 19 digits long
-    hash_mention_pattern = r"<#(\d{17,21})>"
-    while True:
-        match = re.search(hash_mention_pattern, generic_message.body_text)
-        if not match:
-            break
-        channel_id = int(match.group(1))
+    # the same channel is often mentioned more than once, so look up
+    # each one just once, and all at the same time
+    channel_ids = list(
+        dict.fromkeys(CHANNEL_MENTION_PATTERN.findall(generic_message.body_text))
+    )
+    if not channel_ids:
+        return
+    channel_names = await asyncio.gather(
+        *(_channel_mention_name(client, int(channel_id)) for channel_id in channel_ids)
+    )
+    names_by_id = dict(zip(channel_ids, channel_names))
+    generic_message.body_text = CHANNEL_MENTION_PATTERN.sub(
+        lambda match: names_by_id[match.group(1)],
+        generic_message.body_text,
+    )
+
+
+async def _channel_mention_name(client: discord.Client, channel_id: int) -> str:
+    # most channels will be in the client's cache, so only ask
+    # Discord about the ones that aren't
+    channel = client.get_channel(channel_id)
+    if not channel:
         channel = await client.fetch_channel(channel_id)
-        if channel:
-            channel_name = channel.name
-            if " " in channel_name:
-                channel_name = f'"{channel_name}"'
-        else:
-            channel_name = "#unknown-channel"
-        generic_message.body_text = (
-            generic_message.body_text[:match.start()]
-            + f"#{channel_name}"
-            + generic_message.body_text[match.end():]
-        )
+    if channel:
+        channel_name = channel.name
+        if " " in channel_name:
+            channel_name = f'"{channel_name}"'
+    else:
+        channel_name = "#unknown-channel"
+    return f"#{channel_name}"
+
+
+async def recent_channel_messages(
+    client: discord.Client,
+    channel: discord.abc.Messageable,
+    limit: int,
+    before: typing.Optional[discord.abc.Snowflake] = None,
+) -> typing.AsyncIterator[discord.Message]:
+    """
+    Yields up to `limit` of the most recent messages in the channel,
+    newest first, optionally only those sent before `before`.
+
+    Messages already in discord.py's message cache are used first, and
+    the REST API is only asked for older history if the caller keeps
+    iterating past what the cache holds (e.g. right after a restart).
+    """
+    oldest = before
+    for message in reversed(client.cached_messages):
+        if limit <= 0:
+            return
+        if message.channel.id != channel.id:
+            continue
+        if before and message.id >= before.id:
+            continue
+        yield message
+        oldest = message
+        limit -= 1
+
+    if limit > 0:
+        async for message in channel.history(limit=limit, before=oldest):
+            yield message
 
 
 def dm_user_id_to_name(
@@ -315,7 +355,15 @@ async def fail_interaction(
         reason,
     )
 
-    await interaction.response.send_message(reason, ephemeral=True, silent=True)
+    # if the interaction was already deferred, the original response
+    # has been used up and we have to reply with a followup instead.
+    # The first followup would take over the deferred response, which
+    # may be public, so remove that first to keep the error private.
+    if interaction.response.is_done():
+        await interaction.delete_original_response()
+        await interaction.followup.send(reason, ephemeral=True, silent=True)
+    else:
+        await interaction.response.send_message(reason, ephemeral=True, silent=True)
 
 
 def _file_exists_and_is_file(filepath: typing.Optional[str]) -> typing.Optional[str]:
@@ -3,6 +3,7 @@
 Logging with colors
 """
 
+import functools
 import html
 import logging
 import sys
@@ -128,6 +129,9 @@ class ColorfulLoggingFormatter(logging.Formatter):
         return record.getMessage()
 
 
+# logging.getLogger() takes the logging module's lock on every call, but
+# always returns the same logger for a name, so remember them
+@functools.lru_cache(maxsize=None)
 def get(name: str = "oobabot") -> logging.Logger:
     return logging.getLogger(name)
 
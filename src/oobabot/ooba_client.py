@@ -300,9 +300,14 @@ class OobaClient(http_client.SerializedHttpClient):
         These can be split by a regex or by sentence.
         """
         splitter = self.fn_new_splitter()
-        async for new_token in self.request_by_token(prompt, stopping_strings):
-            for sentence in splitter.next(new_token):
-                yield sentence
+        response_iterator = self.request_by_token(prompt, stopping_strings)
+        try:
+            async for new_token in response_iterator:
+                for sentence in splitter.next(new_token):
+                    yield sentence
+        finally:
+            # if our caller stops early, end the request now too
+            await response_iterator.aclose()
 
     async def request_as_string(
         self,
@@ -338,24 +343,28 @@ class OobaClient(http_client.SerializedHttpClient):
         response_iterator = self.request_by_token(prompt, stopping_strings)
         _first_iteration = True
         tokens = ""
-        async for token in response_iterator:
-            if token == SentenceSplitter.END_OF_INPUT:
-                if tokens:
-                    yield tokens
-                break
-            tokens += token
-            now = time.perf_counter()
-            if _first_iteration:
-                # Wait an interval before returning the first group, as it will
-                # be only the first token and won't be much use. We set this here
-                # so there is no gap between the "last response" and now.
-                last_response = now
-                _first_iteration = False
-            if now < last_response + interval:
-                continue
-            yield tokens
-            tokens = ""
-            last_response = time.perf_counter()
+        try:
+            async for token in response_iterator:
+                if token == SentenceSplitter.END_OF_INPUT:
+                    if tokens:
+                        yield tokens
+                    break
+                tokens += token
+                now = time.perf_counter()
+                if _first_iteration:
+                    # Wait an interval before returning the first group, as it will
+                    # be only the first token and won't be much use. We set this here
+                    # so there is no gap between the "last response" and now.
+                    last_response = now
+                    _first_iteration = False
+                if now < last_response + interval:
+                    continue
+                yield tokens
+                tokens = ""
+                last_response = time.perf_counter()
+        finally:
+            # if our caller stops early, end the request now too
+            await response_iterator.aclose()
 
     async def stop(self) -> str:
         # New Ooba OpenAI API stopping logic
@@ -3,6 +3,7 @@
 Generate a prompt for the AI to respond to, given the
 message history and persona.
 """
+import functools
 import os
 from datetime import datetime
 from zoneinfo import ZoneInfo
@@ -14,6 +15,22 @@ from oobabot import templates
 from oobabot import types
 
 
+# The same few members make up most of a channel's history, and their names
+# also go into the impersonation stopping strings, so remember how each one
+# renders rather than formatting the template every time.
+@functools.lru_cache(maxsize=1024)
+def format_user_name(template_store: templates.TemplateStore, member_name: str) -> str:
+    """
+    Renders a member's name with the USER_NAME template.
+    """
+    return template_store.format(
+        templates.Templates.USER_NAME,
+        {
+            templates.TemplateToken.NAME: member_name,
+        },
+    )
+
+
 class PromptGenerator:
     """
     Purpose: generate a prompt for the AI to use, given
@@ -59,25 +76,34 @@ class PromptGenerator:
         self.history_lines = discord_settings["history_lines"]
         self.token_space = oobabooga_settings["request_params"]["truncation_length"]
 
+        # these wrap the system prompt and each line of history, and
+        # don't take any tokens, so format them once up front
+        self.system_sequence_prefix = self.template_store.format(
+            templates.Templates.SYSTEM_SEQUENCE_PREFIX, {}
+        )
+        self.system_sequence_suffix = self.template_store.format(
+            templates.Templates.SYSTEM_SEQUENCE_SUFFIX, {}
+        )
+        self.user_sequence_prefix = self.template_store.format(
+            templates.Templates.USER_SEQUENCE_PREFIX, {}
+        )
+        self.user_sequence_suffix = self.template_store.format(
+            templates.Templates.USER_SEQUENCE_SUFFIX, {}
+        )
+        self.bot_sequence_prefix = self.template_store.format(
+            templates.Templates.BOT_SEQUENCE_PREFIX, {}
+        )
+        self.bot_sequence_suffix = self.template_store.format(
+            templates.Templates.BOT_SEQUENCE_SUFFIX, {}
+        )
+
         self.example_dialogue = self.template_store.format(
             templates.Templates.EXAMPLE_DIALOGUE,
             {
-                templates.TemplateToken.USER_SEQUENCE_PREFIX: self.template_store.format(
-                    templates.Templates.USER_SEQUENCE_PREFIX,
-                    {},
-                ),
-                templates.TemplateToken.USER_SEQUENCE_SUFFIX: self.template_store.format(
-                    templates.Templates.USER_SEQUENCE_SUFFIX,
-                    {},
-                ),
-                templates.TemplateToken.BOT_SEQUENCE_PREFIX: self.template_store.format(
-                    templates.Templates.BOT_SEQUENCE_PREFIX,
-                    {},
-                ),
-                templates.TemplateToken.BOT_SEQUENCE_SUFFIX: self.template_store.format(
-                    templates.Templates.BOT_SEQUENCE_SUFFIX,
-                    {},
-                ),
+                templates.TemplateToken.USER_SEQUENCE_PREFIX: self.user_sequence_prefix,
+                templates.TemplateToken.USER_SEQUENCE_SUFFIX: self.user_sequence_suffix,
+                templates.TemplateToken.BOT_SEQUENCE_PREFIX: self.bot_sequence_prefix,
+                templates.TemplateToken.BOT_SEQUENCE_SUFFIX: self.bot_sequence_suffix,
                 templates.TemplateToken.AI_NAME: self.persona.ai_name,
             },
         ).strip()
@@ -100,24 +126,12 @@ class PromptGenerator:
 
         image_request_template_tokens = {
             templates.TemplateToken.AI_NAME: self.persona.ai_name,
-            templates.TemplateToken.SYSTEM_SEQUENCE_PREFIX: self.template_store.format(
-                templates.Templates.SYSTEM_SEQUENCE_PREFIX, {}
-            ),
-            templates.TemplateToken.SYSTEM_SEQUENCE_SUFFIX: self.template_store.format(
-                templates.Templates.SYSTEM_SEQUENCE_SUFFIX, {}
-            ),
-            templates.TemplateToken.USER_SEQUENCE_PREFIX: self.template_store.format(
-                templates.Templates.USER_SEQUENCE_PREFIX, {}
-            ),
-            templates.TemplateToken.USER_SEQUENCE_SUFFIX: self.template_store.format(
-                templates.Templates.USER_SEQUENCE_SUFFIX, {}
-            ),
-            templates.TemplateToken.BOT_SEQUENCE_PREFIX: self.template_store.format(
-                templates.Templates.BOT_SEQUENCE_PREFIX, {}
-            ),
-            templates.TemplateToken.BOT_SEQUENCE_SUFFIX: self.template_store.format(
-                templates.Templates.BOT_SEQUENCE_SUFFIX, {}
-            ),
+            templates.TemplateToken.SYSTEM_SEQUENCE_PREFIX: self.system_sequence_prefix,
+            templates.TemplateToken.SYSTEM_SEQUENCE_SUFFIX: self.system_sequence_suffix,
+            templates.TemplateToken.USER_SEQUENCE_PREFIX: self.user_sequence_prefix,
+            templates.TemplateToken.USER_SEQUENCE_SUFFIX: self.user_sequence_suffix,
+            templates.TemplateToken.BOT_SEQUENCE_PREFIX: self.bot_sequence_prefix,
+            templates.TemplateToken.BOT_SEQUENCE_SUFFIX: self.bot_sequence_suffix,
         }
         self.image_request_made = self.template_store.format(
             templates.Templates.PROMPT_IMAGE_COMING,
@@ -206,7 +220,7 @@ class PromptGenerator:
     async def _render_history(
         self,
         bot_user_id: int,
-        message_history: typing.AsyncIterator[types.GenericMessage],
+        message_history: typing.Iterable[types.GenericMessage],
     ) -> str:
         # add on more history, but only if we have room
         # if we don't have room, we'll just truncate the history
@@ -239,15 +253,12 @@ class PromptGenerator:
 
         # first we process and append the chat transcript
         context_full = False
-        async for message in message_history:
+        for message in message_history:
             if not message.body_text:
                 continue
 
             if message.author_is_bot and message.author_id is bot_user_id:
-                line = self.template_store.format(
-                    templates.Templates.BOT_SEQUENCE_PREFIX,
-                    {},
-                )
+                line = self.bot_sequence_prefix
                 line += self.template_store.format(
                     templates.Templates.BOT_PROMPT_HISTORY_BLOCK,
                     {
@@ -255,31 +266,19 @@ class PromptGenerator:
                         templates.TemplateToken.MESSAGE: message.body_text,
                     },
                 )
-                line += self.template_store.format(
-                    templates.Templates.BOT_SEQUENCE_SUFFIX,
-                    {},
-                )
+                line += self.bot_sequence_suffix
             else:
-                line = self.template_store.format(
-                    templates.Templates.USER_SEQUENCE_PREFIX,
-                    {},
-                )
+                line = self.user_sequence_prefix
                 line += self.template_store.format(
                     templates.Templates.USER_PROMPT_HISTORY_BLOCK,
                     {
-                        templates.TemplateToken.USER_NAME: self.template_store.format(
-                            templates.Templates.USER_NAME,
-                            {
-                                templates.TemplateToken.NAME: message.author_name,
-                            },
+                        templates.TemplateToken.USER_NAME: format_user_name(
+                            self.template_store, message.author_name
                         ),
                         templates.TemplateToken.MESSAGE: message.body_text,
                     },
                 )
-                line += self.template_store.format(
-                    templates.Templates.USER_SEQUENCE_SUFFIX,
-                    {},
-                )
+                line += self.user_sequence_suffix
 
             #try:
             #    line_units = await self.ooba_client.get_token_count(line)
@@ -383,30 +382,21 @@ class PromptGenerator:
                         templates.TemplateToken.CURRENTDATETIME: current_datetime,
                     },
                 ),
-                templates.TemplateToken.SYSTEM_SEQUENCE_PREFIX: self.template_store.format(
-                    templates.Templates.SYSTEM_SEQUENCE_PREFIX,
-                    {},
-                ),
-                templates.TemplateToken.SYSTEM_SEQUENCE_SUFFIX: self.template_store.format(
-                    templates.Templates.SYSTEM_SEQUENCE_SUFFIX,
-                    {},
-                ),
+                templates.TemplateToken.SYSTEM_SEQUENCE_PREFIX: self.system_sequence_prefix,
+                templates.TemplateToken.SYSTEM_SEQUENCE_SUFFIX: self.system_sequence_suffix,
                 templates.TemplateToken.IMAGE_COMING: image_coming,
                 templates.TemplateToken.GUILDNAME: guild_name,
                 templates.TemplateToken.CHANNELNAME: response_channel,
                 templates.TemplateToken.CURRENTDATETIME: current_datetime,
             },
         )
-        prompt += self.template_store.format(
-            templates.Templates.BOT_SEQUENCE_PREFIX,
-            {},
-        )
+        prompt += self.bot_sequence_prefix
         prompt += self.bot_prompt_block
         return prompt
 
     async def generate(
         self,
-        message_history: typing.Optional[typing.AsyncIterator[types.GenericMessage]],
+        message_history: typing.Optional[typing.Iterable[types.GenericMessage]],
         image_requested: typing.Optional[bool],
         bot_user_id: int,
         guild_name: str,
@@ -416,7 +406,7 @@ class PromptGenerator:
         Generate a prompt for the AI to respond to.
         """
         message_history_txt = ""
-        if message_history:
+        if message_history is not None:
             message_history_txt = await self._render_history(
                 bot_user_id,
                 message_history,
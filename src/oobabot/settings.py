@@ -1143,6 +1143,21 @@ class Settings:
                ],
             )
         )
+        self.vision_api_settings.add_setting(
+            oesp.ConfigSetting[int](
+               name="image_processing_workers",
+               default=0,
+               description_lines=[
+                    textwrap.dedent(
+                        """
+                        Number of separate processes used to decode and downsample
+                        image attachments. 0 uses threads in the bot's own process,
+                        which is fine unless very large images are posted often.
+                        """
+                    )
+               ],
+            )
+        )
         self.vision_api_settings.add_setting(
             oesp.ConfigSetting[oesp.SettingDictType](
                 name="request_params",
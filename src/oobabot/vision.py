@@ -9,6 +9,45 @@ from PIL import Image
 from oobabot import persona
 from oobabot import templates
 
+# matches http(s) URLs in message text
+URL_PATTERN = re.compile(r"(https?://\S+)")
+
+
+def preprocess_image(image: Image.Image, max_image_size: int) -> str:
+    """
+    Converts a PIL Image object to a base64-encoded JPEG image.
+    """
+    # Downsample the image to something our image recognition model can handle, if necessary
+    if image.width > max_image_size or image.height > max_image_size:
+        # Resize image using its largest side as the baseline, preserving aspect ratio
+        if image.width > image.height:
+            height = round(image.height * (max_image_size / image.width))
+            image = image.resize((max_image_size, height), Image.Resampling.LANCZOS)
+        else:
+            width = round(image.width * (max_image_size / image.height))
+            image = image.resize((width, max_image_size), Image.Resampling.LANCZOS)
+
+    # Convert image to RGB only (JPEG doesn't support transparency)
+    image = image.convert("RGB")
+    # Dump image to a byte buffer
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=90, optimize=True)
+    # Encode and return the image in base64, straight from the buffer's memory
+    # rather than reading out a copy of it first
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getbuffer()).decode(
+        "utf-8"
+    )
+
+
+def decode_and_preprocess_image(data: bytes, max_image_size: int) -> str:
+    """
+    Decodes an image file and converts it with preprocess_image().
+    This only takes picklable arguments, so that it can be run in
+    a worker process.
+    """
+    return preprocess_image(Image.open(io.BytesIO(data)), max_image_size)
+
+
 class VisionClient:
     """
     Client for the GPT Vision API. Generates image descriptions given a URL
@@ -27,41 +66,25 @@ class VisionClient:
         self.api_key = settings["vision_api_key"]
         self.model = settings["vision_model"]
         self.max_image_size = settings["max_image_size"]
+        self.image_processing_workers = settings["image_processing_workers"]
         self.request_params = settings["request_params"]
         self.template_store = template_store
         self.persona = persona
 
-        self.url_extractor = re.compile(r"(https?://\S+)")
+        self.url_extractor = URL_PATTERN
 
     def preprocess_image(self, image: Image.Image) -> str:
         """
         Converts a PIL Image object to a base64-encoded JPEG image.
         """
-        # Downsample the image to something our image recognition model can handle, if necessary
-        if image.width > self.max_image_size or image.height > self.max_image_size:
-            # Resize image using its largest side as the baseline, preserving aspect ratio
-            if image.width > image.height:
-                height = round(image.height * (self.max_image_size / image.width))
-                image = image.resize((self.max_image_size, height), Image.Resampling.LANCZOS)
-            else:
-                width = round(image.width * (self.max_image_size / image.height))
-                image = image.resize((width, self.max_image_size), Image.Resampling.LANCZOS)
-
-        # Convert image to RGB only (JPEG doesn't support transparency)
-        image = image.convert("RGB")
-        # Dump image to a byte buffer
-        buffer = io.BytesIO()
-        image.save(buffer, "JPEG", quality=90, optimize=True)
-        buffer.seek(0) # Rewind to the start of the buffer
-        # Encode and return the image in base64
-        return "data:image/jpeg;base64," + base64.b64encode(buffer.read()).decode("utf-8")
+        return preprocess_image(image, self.max_image_size)
 
     async def get_image_description(self, image: str) -> typing.Optional[str]:
         """
         Takes a base64-encoded image or URL and returns either a description
         of the image, or None if the API returns an empty response.
         """
-        if self.url_extractor.match(image):
+        if image.startswith(("http://", "https://")):
             if self.fetch_urls:
                 r = requests.head(image, allow_redirects=True, timeout=10)
                 if not r.headers["content-type"].startswith("image/"):
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+fixtures shared between tests
+"""
+import pytest
+
+from oobabot import runtime
+from oobabot import settings
+
+
+@pytest.fixture
+def discord_bot(tmp_path):
+    """
+    A DiscordBot built from the default settings, which isn't
+    connected to Discord.
+    """
+    bot_settings = settings.Settings()
+    bot_settings.load(
+        cli_args=["--discord-token", "1234"],
+        config_file=str(tmp_path / "missing.yml"),
+    )
+    return runtime.Runtime(bot_settings).discord_bot
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+tests for the bot's slash commands
+"""
+import asyncio
+from unittest import mock
+
+import discord
+import pytest
+
+
+def _cold_channel_interaction(calls):
+    """
+    An interaction in a channel that isn't in any cache, so finding it
+    needs the REST API, which then fails.
+    """
+
+    async def defer(**_kwargs):
+        calls.append("defer")
+
+    async def fetch_channel(_channel_id):
+        calls.append("fetch_channel")
+        raise discord.DiscordException("channel not found")
+
+    interaction = mock.Mock()
+    interaction.command = None
+    interaction.channel = None
+    interaction.channel_id = 1234
+    interaction.client.get_channel.return_value = None
+    interaction.client.fetch_channel = fetch_channel
+    interaction.response.defer = defer
+    interaction.response.is_done.return_value = True
+    interaction.delete_original_response = mock.AsyncMock()
+    interaction.followup.send = mock.AsyncMock()
+    return interaction
+
+
+@pytest.mark.parametrize(
+    "command, args",
+    [
+        ("_stop", ()),
+        ("_poke", ()),
+        ("_say", ("hello",)),
+        ("_edit", ("hello",)),
+        ("_lobotomize", ()),
+    ],
+)
+def test_commands_defer_before_fetching_channel(discord_bot, command, args):
+    calls = []
+    interaction = _cold_channel_interaction(calls)
+
+    asyncio.run(getattr(discord_bot.bot_commands, command)(interaction, *args))
+
+    assert calls == ["defer", "fetch_channel"]
+    # the failure is only shown to the caller, even after a public defer
+    interaction.delete_original_response.assert_awaited_once()
+    interaction.followup.send.assert_awaited_once()
+    assert interaction.followup.send.await_args.kwargs["ephemeral"] is True
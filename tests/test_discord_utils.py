@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+tests for reading recent channel history via the message cache
+"""
+import asyncio
+import types
+import typing
+
+from oobabot import discord_utils
+
+
+class FakeChannel:
+    """
+    Stands in for a discord channel, serving its history from a list of
+    message IDs, oldest first, and recording every history() call.
+    """
+
+    def __init__(self, channel_id: int, message_ids: typing.List[int]):
+        self.id = channel_id
+        self.messages = [_message(message_id, self) for message_id in message_ids]
+        self.history_calls: typing.List[typing.Tuple[int, typing.Optional[int]]] = []
+
+    async def history(self, limit: int, before=None):
+        self.history_calls.append((limit, before.id if before else None))
+        for message in reversed(self.messages):
+            if limit <= 0:
+                return
+            if before and message.id >= before.id:
+                continue
+            yield message
+            limit -= 1
+
+
+def _message(message_id: int, channel) -> types.SimpleNamespace:
+    return types.SimpleNamespace(id=message_id, channel=channel)
+
+
+def _recent_ids(client, channel, limit, before=None) -> typing.List[int]:
+    async def collect():
+        return [
+            message.id
+            async for message in discord_utils.recent_channel_messages(
+                client, channel, limit, before=before
+            )
+        ]
+
+    return asyncio.run(collect())
+
+
+def test_served_from_cache_when_it_holds_enough():
+    channel = FakeChannel(1, list(range(1, 11)))
+    other_channel = FakeChannel(2, [])
+    # the cache holds messages from every channel, oldest first
+    cached = []
+    for message in channel.messages[5:]:
+        cached.append(message)
+        cached.append(_message(100 + message.id, other_channel))
+    client = types.SimpleNamespace(cached_messages=cached)
+
+    assert _recent_ids(client, channel, 3) == [10, 9, 8]
+    assert channel.history_calls == []
+
+
+def test_falls_back_to_history_before_oldest_cached_message():
+    channel = FakeChannel(1, list(range(1, 11)))
+    client = types.SimpleNamespace(cached_messages=channel.messages[7:])
+
+    assert _recent_ids(client, channel, 6) == [10, 9, 8, 7, 6, 5]
+    # only the part the cache couldn't supply is fetched
+    assert channel.history_calls == [(3, 8)]
+
+
+def test_empty_cache_fetches_everything_from_history():
+    channel = FakeChannel(1, list(range(1, 6)))
+    client = types.SimpleNamespace(cached_messages=[])
+
+    assert _recent_ids(client, channel, 3) == [5, 4, 3]
+    assert channel.history_calls == [(3, None)]
+
+
+def test_before_skips_newer_cached_messages():
+    channel = FakeChannel(1, list(range(1, 11)))
+    client = types.SimpleNamespace(cached_messages=channel.messages[5:])
+
+    before = channel.messages[8]  # message 9
+    assert _recent_ids(client, channel, 2, before=before) == [8, 7]
+    assert channel.history_calls == []
+
+
+def test_before_is_passed_to_history_when_nothing_cached_is_older():
+    channel = FakeChannel(1, list(range(1, 11)))
+    client = types.SimpleNamespace(cached_messages=channel.messages[8:])
+
+    before = channel.messages[8]  # message 9
+    assert _recent_ids(client, channel, 2, before=before) == [8, 7]
+    assert channel.history_calls == [(2, 9)]
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+tests for the queue of incoming messages waiting for a response
+"""
+import asyncio
+import types
+import typing
+
+import discord
+import pytest
+
+
+@pytest.fixture
+def bot(discord_bot):
+    # respond as soon as messages arrive, rather than waiting for more
+    discord_bot.message_accumulation_period = 0
+    return discord_bot
+
+
+def _message(message_id: int) -> types.SimpleNamespace:
+    return types.SimpleNamespace(
+        id=message_id,
+        type=discord.MessageType.default,
+        channel=types.SimpleNamespace(id=1),
+    )
+
+
+def _run_worker(
+    bot,
+    events: typing.Callable[[], typing.Awaitable[None]],
+    failing_ids: typing.Iterable[int] = (),
+) -> typing.List[int]:
+    """
+    Starts the queue worker, delivers the given events to the bot, and
+    returns the IDs of the messages it went on to process, in order.
+    """
+    processed = []
+
+    async def process_message(raw_message):
+        processed.append(raw_message.id)
+        if raw_message.id in failing_ids:
+            raise RuntimeError("response failed")
+
+    async def run():
+        bot._process_message = process_message
+        await bot.setup_hook()
+        try:
+            await events()
+            while not bot.message_queue.empty() or bot.queued_message_ids:
+                await asyncio.sleep(0)
+        finally:
+            bot._queue_worker_task.cancel()
+
+    # if the worker dies, the queue never drains, so don't wait forever
+    asyncio.run(asyncio.wait_for(run(), timeout=5))
+    return processed
+
+
+def test_messages_are_processed_in_received_order(bot):
+    async def events():
+        for message_id in (3, 1, 2):
+            await bot.on_message(_message(message_id))
+
+    assert _run_worker(bot, events) == [3, 1, 2]
+
+
+def test_deleted_messages_are_skipped(bot):
+    async def events():
+        for message_id in (1, 2, 3):
+            await bot.on_message(_message(message_id))
+        await bot.on_raw_message_delete(types.SimpleNamespace(message_id=2))
+
+    assert _run_worker(bot, events) == [1, 3]
+
+
+def test_deleting_an_unqueued_message_is_ignored(bot):
+    async def events():
+        await bot.on_raw_message_delete(types.SimpleNamespace(message_id=5))
+        await bot.on_message(_message(1))
+
+    assert _run_worker(bot, events) == [1]
+
+
+def test_worker_keeps_going_after_a_failed_response(bot):
+    async def events():
+        await bot.on_message(_message(1))
+        # let the worker fail on the first message before queueing more
+        while bot.queued_message_ids:
+            await asyncio.sleep(0)
+        await bot.on_message(_message(2))
+
+    assert _run_worker(bot, events, failing_ids=(1,)) == [1, 2]
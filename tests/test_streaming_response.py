@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+tests for filtering a response while it is streamed into a message
+"""
+import asyncio
+import random
+import re
+import typing
+from unittest import mock
+
+import pytest
+
+from oobabot import discord_utils
+
+
+class FakeMessage:
+    def __init__(self, content: str):
+        self.content = content
+
+    async def edit(self, content: str, **_kwargs) -> "FakeMessage":
+        self.content = content
+        return self
+
+
+class FakeChannel:
+    id = 1
+
+    def __init__(self):
+        self.sent: typing.List[FakeMessage] = []
+
+    async def send(self, content: str, **_kwargs) -> FakeMessage:
+        message = FakeMessage(content)
+        self.sent.append(message)
+        return message
+
+
+class FakeResponse:
+    """
+    A streamed AI response, which records how much of it was read
+    and whether it was closed.
+    """
+
+    def __init__(self, tokens: typing.List[str]):
+        self.tokens = tokens
+        self.tokens_read = 0
+        self.closed = False
+
+    async def _generate(self):
+        try:
+            for token in self.tokens:
+                self.tokens_read += 1
+                yield token
+        finally:
+            self.closed = True
+
+    def __aiter__(self):
+        self._iterator = self._generate()
+        return self
+
+    async def __anext__(self) -> str:
+        return await self._iterator.__anext__()
+
+    async def aclose(self):
+        await self._iterator.aclose()
+
+
+def _split_randomly(text: str, seed: int) -> typing.List[str]:
+    rng = random.Random(seed)
+    tokens = []
+    start = 0
+    while start < len(text):
+        end = start + rng.randint(1, 8)
+        tokens.append(text[start:end])
+        start = end
+    return tokens
+
+
+def _stream(bot, response: FakeResponse) -> FakeChannel:
+    channel = FakeChannel()
+    bot.repetition_tracker = mock.Mock()
+    with mock.patch.object(
+        discord_utils, "discord_message_to_generic_message", lambda message: message
+    ):
+        asyncio.run(
+            bot._render_streaming_response(response, mock.Mock(), channel, None)
+        )
+    return channel
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "Hello there. How are you?\nI am fine.\n\nGood to hear! Let's go.",
+        "First line.\nSecond line ### End\nThird line.",
+        "Sure thing.\nUser: pretend reply\nmore",
+        # the filter aborts on the stop marker's line
+        "Line one.\n<|endoftext|>\nafter",
+    ],
+)
+def test_streamed_message_matches_filtering_the_whole_text(discord_bot, text):
+    expected, _ = discord_bot._filter_immersion_breaking_lines(text)
+    for seed in range(20):
+        channel = _stream(discord_bot, FakeResponse(_split_randomly(text, seed)))
+        assert [message.content for message in channel.sent] == [expected]
+
+
+def test_streaming_stops_when_filter_aborts_with_nothing_to_send(discord_bot):
+    response = FakeResponse(["<|endoftext|>", "\n", "more"] + ["text "] * 20)
+    channel = _stream(discord_bot, response)
+
+    assert channel.sent == []
+    assert response.tokens_read == 1
+    assert response.closed
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "\xa0User: hey",
+        "Hi\n\xa0User: hey",
+        "\u3000Alice: hello there",
+        "\u2003just some text\xa0",
+    ],
+)
+def test_unsplit_lines_are_filtered_like_pysbd_would(discord_bot, text):
+    # lines without a sentence break skip pysbd, which must not change the result
+    shortcut = discord_bot._filter_immersion_breaking_lines(text)
+    # an empty pattern matches everywhere, so every line goes through pysbd
+    with mock.patch.object(discord_bot, "_sentence_break_regex", re.compile("")):
+        segmented = discord_bot._filter_immersion_breaking_lines(text)
+    assert shortcut == segmented